@@ -1,252 +1,2678 @@
 import gradio as gr
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import PyPDF2
-from pinecone import Pinecone, ServerlessSpec
-from sentence_transformers import SentenceTransformer
+import numpy as np
+import base64
 import hashlib
-import uuid
+import sqlite3
+import zlib
 import langdetect
 import os
+import platform
+import re
 from io import BytesIO
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
 from datetime import datetime
 import time
+import asyncio
+import json
+import multiprocessing
+import random
+import queue
+import tempfile
+import threading
+import unicodedata
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pytesseract
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_path
 from PIL import Image
-import requests
+import httpx
 from dotenv import load_dotenv
-from agno.agent import Agent
-from agno.models.google.gemini import Gemini
-from agno.team.team import Team
+
+_import_started = time.perf_counter()
 
 load_dotenv()
 # Load environment variables
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 
-if not GOOGLE_API_KEY:
-    raise ValueError("GOOGLE_API_KEY not found in environment variables. Please set it in your .env file.")
-    
-if not PINECONE_API_KEY:
-    raise ValueError("PINECONE_API_KEY not found in environment variables. Please set it in your .env file.")
+def validate_environment():
+    if not GOOGLE_API_KEY:
+        raise ValueError("GOOGLE_API_KEY not found in environment variables. Please set it in your .env file.")
+        
+    if not PINECONE_API_KEY and VECTOR_STORE != "local":
+        raise ValueError("PINECONE_API_KEY not found in environment variables. Please set it in your .env file.")
+
+# Request handling: chats in flight per process and uploads processed at once
+MAX_CONCURRENT_CHATS = int(os.getenv("MAX_CONCURRENT_CHATS", "32"))
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "2"))
+# Stream Gemini output to the chat, translating sentence by sentence as it arrives
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+
+# Metrics
+# Port of the Prometheus text endpoint served next to the Gradio app (0 disables it)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Also print every observation as a JSON line; the [Tag] text logs are kept either way
+METRICS_LOG_JSON = os.getenv("METRICS_LOG_JSON", "false").lower() in ("1", "true", "yes")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def document_size_label(pages):
+    """Coarse document-size tag so metrics stay low-cardinality"""
+    if pages <= 2:
+        return "1-2"
+    if pages <= 10:
+        return "3-10"
+    if pages <= 50:
+        return "11-50"
+    return "50+"
+
+class Metrics:
+    """Thread-safe latency histograms, counters and gauges, keyed by name and labels"""
+    def __init__(self, buckets=LATENCY_BUCKETS, log_json=METRICS_LOG_JSON):
+        self.buckets = buckets
+        self.log_json = log_json
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        """Record one latency observation (seconds) in the histogram `name`"""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        self._log(name, 'seconds', seconds, labels)
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._log(name, 'value', value, labels)
+
+    def register_gauge(self, name, read, **labels):
+        """Report the current value of `read()` under `name` at every snapshot"""
+        with self._lock:
+            self._gauges[self._key(name, labels)] = read
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observe the duration of the block; labels may be added to the yielded dict inside it"""
+        start = time.perf_counter()
+        labels = dict(labels)
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _log(self, name, field, value, labels):
+        if self.log_json:
+            print(json.dumps({'ts': time.time(), 'metric': name, field: value, **labels}, ensure_ascii=False))
+
+    def snapshot(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+            snapshot = {
+                'histograms': {key: dict(h, counts=list(h['counts'])) for key, h in self._histograms.items()},
+                'counters': dict(self._counters),
+            }
+        snapshot['gauges'] = {key: read() for key, read in gauges.items()}
+        return snapshot
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for key, value in pairs:
+            value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self):
+        """Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        declared = set()
+        for (name, labels), value in sorted(snapshot['counters'].items()):
+            if name not in declared:
+                lines.append(f"# TYPE {name} counter")
+                declared.add(name)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), value in sorted(snapshot['gauges'].items()):
+            if name not in declared:
+                lines.append(f"# TYPE {name} gauge")
+                declared.add(name)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(snapshot['histograms'].items()):
+            if name not in declared:
+                lines.append(f"# TYPE {name} histogram")
+                declared.add(name)
+            for bound, count in zip(self.buckets, histogram['counts']):
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', str(bound))])} {count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the application log
+        pass
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serve /metrics from a daemon thread; returns the server, or None when disabled"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"[Metrics] Serving Prometheus metrics on :{port}/metrics")
+    return server
+
+# Page-level OCR settings
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Pages whose text layer yields fewer characters than this are sent to OCR
+OCR_MIN_PAGE_CHARS = int(os.getenv("OCR_MIN_PAGE_CHARS", "20"))
+
+def ocr_pdf_page(pdf_path, page_number, dpi=OCR_DPI):
+    """Rasterize a single PDF page (1-based) and run Tesseract on it"""
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number)
+    try:
+        return pytesseract.image_to_string(images[0]) if images else ""
+    finally:
+        for image in images:
+            image.close()
+
+def timed_ocr_pdf_page(pdf_path, page_number, dpi=OCR_DPI):
+    """ocr_pdf_page returning (text, seconds), so pool workers report their own OCR time"""
+    start = time.perf_counter()
+    text = ocr_pdf_page(pdf_path, page_number, dpi)
+    return text, time.perf_counter() - start
+
+# Shared State
+# Where per-session state (document registry, conversation history) and the second tier of the
+# extraction cache live: "memory" (default, one process), "sqlite" (worker processes on one host
+# share files under STATE_DIR) or "redis" (any Redis-compatible server)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_DIR = os.getenv("STATE_DIR", "state")
+STATE_REDIS_URL = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+# Expired rows are purged from SQLite stores at most this often
+STATE_PURGE_INTERVAL_SECONDS = 60
+# A Redis key lock expires after this long if its holder dies, and is waited for at most STATE_LOCK_WAIT_SECONDS
+STATE_LOCK_TTL_SECONDS = 10
+STATE_LOCK_WAIT_SECONDS = 5
+
+class SqliteState:
+    """Byte values by key in a SQLite file (WAL mode), shared by every process that opens it.
+
+    With `max_entries` the least recently used rows beyond that count are dropped on write.
+    """
+    shared = True
+    backend = "sqlite"
+
+    def __init__(self, path, max_entries=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        # Reentrant, so get and set can run inside locked()
+        self._lock = threading.RLock()
+        self._in_transaction = False
+        self._last_purge = 0.0
+        # Writers from other processes hold the file lock briefly; wait for them instead of failing
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                return None
+            if self.max_entries:
+                self._db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+                self._commit()
+            return row[0]
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl if ttl else None, now)
+            )
+            if self.max_entries:
+                self._db.execute(
+                    "DELETE FROM entries WHERE key NOT IN (SELECT key FROM entries ORDER BY accessed_at DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+            if now - self._last_purge > STATE_PURGE_INTERVAL_SECONDS:
+                self._db.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+                self._last_purge = now
+            self._commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._commit()
+
+    def _commit(self):
+        # Inside locked() the transaction is committed when the block ends
+        if not self._in_transaction:
+            self._db.commit()
+
+    @contextmanager
+    def locked(self, key):
+        """Hold the database write lock (BEGIN IMMEDIATE) so a get/set of `key` inside is not interleaved with other writers"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            try:
+                yield
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+            finally:
+                self._in_transaction = False
+
+    def stats(self):
+        with self._lock:
+            count = self._db.execute(
+                "SELECT COUNT(*) FROM entries WHERE expires_at IS NULL OR expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+        return {'backend': self.backend, 'keys': count}
+
+class RedisState:
+    """Byte values by key in a Redis-compatible server; expiry and eviction are left to the server"""
+    shared = True
+    backend = "redis"
+
+    def __init__(self, url=STATE_REDIS_URL, prefix=""):
+        import redis
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+        self._client.ping()
+
+    def get(self, key):
+        return self._client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(self.prefix + key, value, ex=max(1, int(ttl)) if ttl else None)
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+    # Delete the lock only if it is still ours, not one taken after ours expired
+    _RELEASE_LOCK = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    @contextmanager
+    def locked(self, key):
+        """Hold a SET NX lock on `key` so a get/set of it inside is not interleaved with other writers"""
+        lock_key = "lock:" + self.prefix + key
+        token = os.urandom(8).hex()
+        deadline = time.monotonic() + STATE_LOCK_WAIT_SECONDS
+        try:
+            while not self._client.set(lock_key, token, nx=True, ex=STATE_LOCK_TTL_SECONDS):
+                if time.monotonic() > deadline:
+                    print(f"[State] Lock on {key} still held after {STATE_LOCK_WAIT_SECONDS}s, going ahead without it")
+                    token = None
+                    break
+                time.sleep(0.01)
+        except Exception as e:
+            print(f"[State] Locking {key} failed ({str(e)}), going ahead without the lock")
+            token = None
+        try:
+            yield
+        finally:
+            if token is not None:
+                try:
+                    self._client.eval(self._RELEASE_LOCK, 1, lock_key, token)
+                except Exception as e:
+                    print(f"[State] Releasing lock on {key} failed: {str(e)}")
+
+    def stats(self):
+        keys = sum(1 for _ in self._client.scan_iter(match=self.prefix + "*", count=1000))
+        return {'backend': self.backend, 'keys': keys, 'db_keys': self._client.dbsize()}
+
+def create_state_store(name, max_entries=None, backend=STATE_BACKEND):
+    """Shared store for one kind of state ("sessions", "extraction_cache"), or None to keep it in process memory"""
+    if backend == "sqlite":
+        return SqliteState(os.path.join(STATE_DIR, f"{name}.sqlite3"), max_entries=max_entries)
+    if backend == "redis":
+        try:
+            return RedisState(STATE_REDIS_URL, prefix=f"{name}:")
+        except Exception as e:
+            print(f"[State] Redis unavailable ({str(e)}), keeping {name} in process memory")
+    return None
+
+# Extraction Cache
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "256"))
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Set a directory to keep extraction results across restarts (empty disables the disk tier)
+EXTRACTION_CACHE_DIR = os.getenv("EXTRACTION_CACHE_DIR", "")
+EXTRACTION_CACHE_DISK_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_DISK_MAX_ENTRIES", "5000"))
+
+def content_hash(data):
+    """Fast content hash used to address uploads and cached results"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def encode_cache_value(value):
+    """JSON bytes, with numpy arrays as base64 .npy payloads.
+
+    No pickle: entries load in any process that shares the tier (the app, ingest.py),
+    and reading one never runs code.
+    """
+    def encode_object(obj):
+        if isinstance(obj, np.ndarray):
+            buffer = BytesIO()
+            np.save(buffer, obj, allow_pickle=False)
+            return {'__ndarray__': base64.b64encode(buffer.getvalue()).decode('ascii')}
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError(f"cannot cache {type(obj).__name__}")
+    return json.dumps(value, default=encode_object, ensure_ascii=False).encode('utf-8')
+
+def decode_cache_value(raw):
+    def decode_object(obj):
+        if len(obj) == 1 and '__ndarray__' in obj:
+            return np.load(BytesIO(base64.b64decode(obj['__ndarray__'])), allow_pickle=False)
+        return obj
+    return json.loads(raw, object_hook=decode_object)
+
+class ExtractionCache:
+    """Size- and byte-bounded LRU cache in front of an optional shared tier.
+
+    Entries are addressed by a kind ("pages", "embeddings", ...) and a content hash.
+    The second tier is a SQLite file under `cache_dir` if one is given, otherwise the
+    configured state backend, so worker processes reuse each other's extraction results.
+    Values of the kinds in `codecs` (objects such as indexes) are stored in the shared
+    tier as plain data and rebuilt when read back.
+    """
+    # kind -> (object to plain data, plain data to object)
+    codecs = {}
+
+    def __init__(self, max_entries=EXTRACTION_CACHE_MAX_ENTRIES, max_bytes=EXTRACTION_CACHE_MAX_BYTES,
+                 cache_dir=EXTRACTION_CACHE_DIR, max_disk_entries=EXTRACTION_CACHE_DISK_MAX_ENTRIES, shared=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_hits = 0
+        if shared is None:
+            if cache_dir:
+                shared = SqliteState(os.path.join(cache_dir, "extraction_cache.sqlite3"), max_entries=max_disk_entries)
+            else:
+                shared = create_state_store("extraction_cache", max_entries=max_disk_entries)
+        self._shared = shared
+
+    def get(self, kind, digest):
+        key = f"{kind}:{digest}"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.increment('cache_requests_total', cache='extraction', result='hit')
+                return entry[0]
+        blob = self._disk_get(key)
+        if blob is None:
+            with self._lock:
+                self.misses += 1
+            metrics.increment('cache_requests_total', cache='extraction', result='miss')
+            return None
+        try:
+            raw = zlib.decompress(blob)
+            value = decode_cache_value(raw)
+            if kind in self.codecs:
+                value = self.codecs[kind][1](value)
+        except Exception as e:
+            # Stale or foreign entry: treat it as a miss and drop it
+            print(f"[Cache] Discarding undecodable {kind} entry: {str(e)}")
+            self._disk_delete(key)
+            with self._lock:
+                self.misses += 1
+            metrics.increment('cache_requests_total', cache='extraction', result='miss')
+            return None
+        with self._lock:
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, value, len(raw))
+        metrics.increment('cache_requests_total', cache='extraction', result='disk_hit')
+        return value
+
+    def put(self, kind, digest, value):
+        key = f"{kind}:{digest}"
+        raw = encode_cache_value(self.codecs[kind][0](value) if kind in self.codecs else value)
+        with self._lock:
+            self._remember(key, value, len(raw))
+        self._disk_put(key, raw)
+
+    def _remember(self, key, value, size):
+        # Caller holds the lock
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def _disk_get(self, key):
+        if self._shared is None:
+            return None
+        try:
+            return self._shared.get(key)
+        except Exception as e:
+            print(f"[Cache] Shared tier read failed: {str(e)}")
+            return None
+
+    def _disk_delete(self, key):
+        if self._shared is None:
+            return
+        try:
+            self._shared.delete(key)
+        except Exception as e:
+            print(f"[Cache] Shared tier delete failed: {str(e)}")
+
+    def _disk_put(self, key, raw):
+        if self._shared is None:
+            return
+        try:
+            self._shared.set(key, zlib.compress(raw))
+        except Exception as e:
+            print(f"[Cache] Shared tier write failed: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+# Embedding Service
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# How long the batcher waits for more requests before encoding a partial batch
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "10"))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))
 
-genai.configure(api_key=GOOGLE_API_KEY)
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+# Input length (in tokenizer tokens) beyond which MiniLM truncates
+EMBEDDING_MAX_SEQ_LENGTH = 256
+# "torch" (default), "onnx", or "onnx-int8" for the dynamically quantized ONNX export of the same model
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# ONNX file inside the model repository (defaults to model.onnx, or the int8 build matching this CPU)
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "")
+# Threads used by the embedding runtime (0 keeps the library default)
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+# Compare an ONNX backend with the PyTorch model at start-up and fall back to PyTorch if they disagree
+EMBEDDING_PARITY_CHECK = os.getenv("EMBEDDING_PARITY_CHECK", "false").lower() in ("1", "true", "yes")
+EMBEDDING_PARITY_MIN_COSINE = float(os.getenv("EMBEDDING_PARITY_MIN_COSINE", "0.99"))
+PARITY_SAMPLE_TEXTS = [
+    "Hemoglobin    11.2    g/dL    13.0 - 17.0",
+    "Thyroid Stimulating Hormone (TSH)    5.8    uIU/mL    0.4 - 4.0",
+    "Results should be correlated clinically with the patient's history and medication.",
+    "Is my blood sugar normal?",
+    "मेरा हीमोग्लोबिन कम क्यों है?",
+    "Fasting Blood Glucose 126 mg/dL, HbA1c 6.8 %, suggestive of diabetes mellitus.",
+]
+
+def quantized_onnx_file():
+    """The int8 ONNX build of the model published for this CPU's instruction set"""
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "onnx/model_qint8_arm64.onnx"
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu_flags = f.read()
+    except OSError:
+        cpu_flags = ""
+    if "avx512_vnni" in cpu_flags:
+        return "onnx/model_qint8_avx512_vnni.onnx"
+    if "avx512f" in cpu_flags:
+        return "onnx/model_qint8_avx512.onnx"
+    return "onnx/model_qint8_avx2.onnx"
+
+def load_embedding_model(backend=EMBEDDING_BACKEND, threads=EMBEDDING_THREADS, model_name=EMBEDDING_MODEL_NAME):
+    """Load the sentence embedding model on the requested runtime; every backend shares the same tokenizer"""
+    # Imported here: torch and sentence-transformers dominate import time
+    from sentence_transformers import SentenceTransformer
+    if backend == "torch":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        return SentenceTransformer(model_name)
+    if backend not in ("onnx", "onnx-int8"):
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    file_name = EMBEDDING_ONNX_FILE or (quantized_onnx_file() if backend == "onnx-int8" else "onnx/model.onnx")
+    model_kwargs = {"file_name": file_name}
+    if threads:
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        model_kwargs["session_options"] = options
+    return SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs)
+
+def load_tokenizer(model_name=EMBEDDING_MODEL_NAME):
+    """The embedding model's tokenizer alone, for processes that chunk but do not embed"""
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(f"sentence-transformers/{model_name}")
+
+def embedding_parity(model, reference, texts=PARITY_SAMPLE_TEXTS):
+    """(min, mean) cosine similarity between two models' embeddings of the same texts"""
+    a = np.asarray(model.encode(texts), dtype=np.float32)
+    b = np.asarray(reference.encode(texts), dtype=np.float32)
+    cosines = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    return float(cosines.min()), float(cosines.mean())
+
+class EmbeddingService:
+    """Micro-batching front end for a SentenceTransformer model.
+
+    Requests from concurrent sessions are coalesced into a single encode call,
+    identical texts are served from an LRU cache, and results are float32 arrays.
+    """
+    def __init__(self, model, batch_size=EMBED_BATCH_SIZE, max_wait_ms=EMBED_MAX_WAIT_MS, cache_size=EMBED_CACHE_SIZE):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self.batches = 0
+        self.encoded = 0
+        self.cache_hits = 0
+
+    def submit(self, texts):
+        """Queue texts for embedding and return a Future resolving to an (n, dim) float32 array"""
+        texts = list(texts)
+        future = Future()
+        vectors = self._lookup(texts)
+        if all(vector is not None for vector in vectors):
+            future.set_result(self._stack(vectors))
+            return future
+        self._ensure_worker()
+        self._queue.put((texts, vectors, future))
+        return future
+
+    def embed(self, texts):
+        return self.submit(texts).result()
+
+    def _stack(self, vectors):
+        if not vectors:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.stack(vectors)
+
+    def _lookup(self, texts):
+        vectors = []
+        with self._cache_lock:
+            for text in texts:
+                key = content_hash(text)
+                vector = self._cache.get(key)
+                if vector is not None:
+                    self._cache.move_to_end(key)
+                    self.cache_hits += 1
+                vectors.append(vector)
+        hits = sum(vector is not None for vector in vectors)
+        metrics.increment('cache_requests_total', hits, cache='embedding', result='hit')
+        metrics.increment('cache_requests_total', len(vectors) - hits, cache='embedding', result='miss')
+        return vectors
+
+    def _store(self, encoded):
+        with self._cache_lock:
+            for text, vector in encoded.items():
+                self._cache[content_hash(text)] = vector
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            # Callers that cancelled while queued are dropped; the rest can no longer cancel
+            if not request[2].set_running_or_notify_cancel():
+                continue
+            batch = [request]
+            pending = sum(vector is None for vector in request[1])
+            deadline = time.monotonic() + self.max_wait
+            while pending < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if not request[2].set_running_or_notify_cancel():
+                    continue
+                batch.append(request)
+                pending += sum(vector is None for vector in request[1])
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch):
+        # Deduplicate texts across all coalesced requests before encoding
+        encoded = {}
+        for texts, vectors, _ in batch:
+            for text, vector in zip(texts, vectors):
+                if vector is None:
+                    encoded.setdefault(text, None)
+        try:
+            if encoded:
+                unique_texts = list(encoded)
+                with metrics.time('embedding_batch_seconds'):
+                    matrix = self.model.encode(unique_texts, batch_size=self.batch_size, convert_to_numpy=True)
+                metrics.increment('embedding_texts_total', len(unique_texts))
+                matrix = np.asarray(matrix, dtype=np.float32)
+                for text, vector in zip(unique_texts, matrix):
+                    encoded[text] = vector
+                self._store(encoded)
+                self.batches += 1
+                self.encoded += len(unique_texts)
+        except Exception as e:
+            print(f"[Embedding] Batch encode failed: {str(e)}")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for texts, vectors, future in batch:
+            future.set_result(self._stack([
+                vector if vector is not None else encoded[text]
+                for text, vector in zip(texts, vectors)
+            ]))
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'encoded': self.encoded,
+            'cache_hits': self.cache_hits,
+            'cache_entries': len(self._cache),
+            'avg_batch_size': self.encoded / self.batches if self.batches else 0.0,
+        }
+
+# Chunking
+# MiniLM truncates inputs at 256 tokens, so chunks are sized below that in tokenizer tokens
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "200"))
+# Number of trailing lines/sentences repeated at the start of the next chunk
+CHUNK_OVERLAP_SEGMENTS = int(os.getenv("CHUNK_OVERLAP_SEGMENTS", "1"))
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?।])\s+(?=\S)')
+TABLE_ROW = re.compile(r'\t|\s{2,}|\|')
+
+def iter_segments(page_texts):
+    """Split page texts into lines, table rows and sentences, one page at a time"""
+    for page_text in page_texts:
+        for line in (page_text or "").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            # Table rows (lab values with units and ranges) are never split
+            if TABLE_ROW.search(line):
+                yield line
+                continue
+            for sentence in SENTENCE_BOUNDARY.split(line):
+                yield sentence
+
+class StreamingChunker:
+    """Packs line/sentence segments into chunks bounded by the embedding model's token count"""
+    def __init__(self, tokenizer, max_tokens=CHUNK_MAX_TOKENS, overlap_segments=CHUNK_OVERLAP_SEGMENTS):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap_segments = overlap_segments
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.tokenize(text))
+
+    def _split_oversized(self, segment):
+        # Last resort for a single line longer than the token budget: split on words
+        piece, piece_tokens = [], 0
+        for word in segment.split():
+            word_tokens = self.count_tokens(word)
+            if piece and piece_tokens + word_tokens > self.max_tokens:
+                yield " ".join(piece), piece_tokens
+                piece, piece_tokens = [], 0
+            piece.append(word)
+            piece_tokens += word_tokens
+        if piece:
+            yield " ".join(piece), piece_tokens
+
+    def iter_chunks(self, page_texts):
+        """Yield chunks as soon as they are full, consuming page texts lazily"""
+        current, current_tokens = [], 0
+        for segment in iter_segments(page_texts):
+            tokens = self.count_tokens(segment)
+            pieces = [(segment, tokens)] if tokens <= self.max_tokens else self._split_oversized(segment)
+            for piece, piece_tokens in pieces:
+                if current and current_tokens + piece_tokens > self.max_tokens:
+                    yield "\n".join(text for text, _ in current)
+                    current = current[-self.overlap_segments:] if self.overlap_segments > 0 else []
+                    current_tokens = sum(n for _, n in current)
+                    while current and current_tokens + piece_tokens > self.max_tokens:
+                        current_tokens -= current.pop(0)[1]
+                current.append((piece, piece_tokens))
+                current_tokens += piece_tokens
+        if current:
+            yield "\n".join(text for text, _ in current)
 
 # Document Processor
 class DocumentProcessor:
-    def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        self.memory_cache = {}
+    def __init__(self, ocr_dpi=OCR_DPI, ocr_workers=OCR_WORKERS, embedding_backend=EMBEDDING_BACKEND, embed=True):
+        self.model_name = EMBEDDING_MODEL_NAME
+        if embed:
+            self.model, self.embedding_backend = self._load_model(embedding_backend)
+            self.embedding_service = EmbeddingService(self.model)
+            tokenizer, max_seq_length = self.model.tokenizer, self.model.max_seq_length
+        else:
+            # Extraction and chunking only (bulk-ingestion workers): load the tokenizer without the model
+            self.model = self.embedding_service = self.embedding_backend = None
+            tokenizer, max_seq_length = load_tokenizer(), EMBEDDING_MAX_SEQ_LENGTH
+        self.chunker = StreamingChunker(tokenizer, max_tokens=min(CHUNK_MAX_TOKENS, max_seq_length - 2))
+        self.cache = ExtractionCache()
+        self.ocr_dpi = ocr_dpi
+        self.ocr_workers = max(1, ocr_workers)
+        self._ocr_pool = None
+        self._ocr_pool_lock = threading.Lock()
 
-    def extract_text_from_pdf(self, pdf_file):
+    @staticmethod
+    def _load_model(backend):
+        """Load the embedding model, falling back to PyTorch if the ONNX backend is missing or disagrees"""
         try:
-            # Handle Gradio's NamedString, UploadedFile, or plain str/bytes
-            file_bytes = None
-            if hasattr(pdf_file, 'file'):
-                file_obj = pdf_file.file
-                file_obj.seek(0)
-                file_bytes = file_obj.read()
-            elif hasattr(pdf_file, 'seek') and hasattr(pdf_file, 'read'):
-                pdf_file.seek(0)
-                file_bytes = pdf_file.read()
-            elif isinstance(pdf_file, (bytes, bytearray)):
-                file_bytes = pdf_file
-            elif isinstance(pdf_file, str):
-                # If it's a path, read the file
-                with open(pdf_file, 'rb') as f:
-                    file_bytes = f.read()
-            else:
-                raise ValueError("Unsupported file type for PDF extraction.")
-            file_hash = hashlib.md5(file_bytes).hexdigest()
-            if file_hash in self.memory_cache:
-                print("[PDF] Using cached version.")
-                return self.memory_cache[file_hash]
-            pdf_bytes = BytesIO(file_bytes)
-            pdf_reader = PyPDF2.PdfReader(pdf_bytes)
-            text = ""
-            print(f"[PDF] Number of pages: {len(pdf_reader.pages)}")
-            for i, page in enumerate(pdf_reader.pages):
-                page_text = None
+            model = load_embedding_model(backend)
+        except Exception as e:
+            if backend == "torch":
+                raise
+            print(f"[Embedding] {backend} backend unavailable ({str(e)}), using torch")
+            return load_embedding_model("torch"), "torch"
+        if backend != "torch" and EMBEDDING_PARITY_CHECK:
+            reference = load_embedding_model("torch")
+            min_cosine, mean_cosine = embedding_parity(model, reference)
+            print(f"[Embedding] {backend} parity with torch: min cosine {min_cosine:.4f}, mean {mean_cosine:.4f}")
+            if min_cosine < EMBEDDING_PARITY_MIN_COSINE:
+                print(f"[Embedding] Parity below {EMBEDDING_PARITY_MIN_COSINE}, using torch")
+                return reference, "torch"
+        print(f"[Embedding] Using the {backend} backend")
+        return model, backend
+
+    def _get_ocr_pool(self):
+        """Lazily create the bounded process pool used for OCR (None means run inline)"""
+        if self.ocr_workers <= 1:
+            return None
+        with self._ocr_pool_lock:
+            if self._ocr_pool is None:
+                # Spawn, not fork: this process runs the embedding, upsert and server threads
+                self._ocr_pool = ProcessPoolExecutor(
+                    max_workers=self.ocr_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return self._ocr_pool
+
+    def _reset_ocr_pool(self):
+        with self._ocr_pool_lock:
+            if self._ocr_pool is not None:
+                self._ocr_pool.shutdown(wait=False, cancel_futures=True)
+                self._ocr_pool = None
+
+    @staticmethod
+    def read_file_bytes(pdf_file):
+        # Handle Gradio's NamedString, UploadedFile, or plain str/bytes
+        if hasattr(pdf_file, 'file'):
+            file_obj = pdf_file.file
+            file_obj.seek(0)
+            return file_obj.read()
+        if hasattr(pdf_file, 'seek') and hasattr(pdf_file, 'read'):
+            pdf_file.seek(0)
+            return pdf_file.read()
+        if isinstance(pdf_file, (bytes, bytearray)):
+            return bytes(pdf_file)
+        if isinstance(pdf_file, str):
+            # If it's a path, read the file
+            with open(pdf_file, 'rb') as f:
+                return f.read()
+        raise ValueError("Unsupported file type for PDF extraction.")
+
+    @staticmethod
+    def _extract_text_layer(page, page_number):
+        page_text = None
+        try:
+            page_text = page.extract_text()
+        except Exception as e:
+            print(f"Error extracting text from page {page_number}: {str(e)}")
+        if not page_text:
+            try:
+                page_text = page.extract_text(layout_mode='raw')
+            except Exception as e:
+                print(f"Alternative extraction failed on page {page_number}: {str(e)}")
+        return page_text or ""
+
+    def _ocr_page(self, pdf_path, page_number, future=None):
+        try:
+            result = None
+            if future is not None:
                 try:
-                    page_text = page.extract_text()
-                except Exception as e:
-                    print(f"Error extracting text from page {i+1}: {str(e)}")
-                if not page_text and hasattr(page, 'extract_text'):
-                    try:
-                        page_text = page.extract_text(layout_mode='raw')
-                    except Exception as e:
-                        print(f"Alternative extraction failed on page {i+1}: {str(e)}")
-                if page_text:
-                    print(f"[PDF] Extracted {len(page_text)} chars from page {i+1}")
-                    text += page_text
+                    result = future.result()
+                except BrokenProcessPool:
+                    print(f"[OCR] Worker pool broke on page {page_number}, retrying inline")
+                    self._reset_ocr_pool()
+            text, seconds = result or timed_ocr_pdf_page(pdf_path, page_number, self.ocr_dpi)
+            metrics.observe('ocr_page_seconds', seconds)
+            return text
+        except Exception as e:
+            print(f"Error performing OCR on page {page_number}: {str(e)}")
+            metrics.increment('ocr_page_errors_total')
+            return ""
+
+    def iter_page_texts(self, file_bytes):
+        """Yield the text of each page in order, running OCR only on pages without a usable text layer"""
+        with metrics.time('pdf_parse_seconds') as labels:
+            pdf_reader = PyPDF2.PdfReader(BytesIO(file_bytes))
+            num_pages = len(pdf_reader.pages)
+            labels['size'] = document_size_label(num_pages)
+            print(f"[PDF] Number of pages: {num_pages}")
+            layer_texts = [self._extract_text_layer(page, i + 1) for i, page in enumerate(pdf_reader.pages)]
+        ocr_pages = [i for i, text in enumerate(layer_texts) if len(text.strip()) < OCR_MIN_PAGE_CHARS]
+        metrics.increment('pdf_pages_total', num_pages - len(ocr_pages), source='text')
+        metrics.increment('pdf_pages_total', len(ocr_pages), source='ocr')
+        if not ocr_pages:
+            for i, text in enumerate(layer_texts):
+                print(f"[PDF] Extracted {len(text)} chars from page {i+1}")
+                yield text
+            return
+
+        print(f"[OCR] {len(ocr_pages)} of {num_pages} pages have no text layer, running OCR at {self.ocr_dpi} DPI")
+        # pdf2image hands a file path to pdftoppm, so write the upload once and
+        # let every worker rasterize only the page it was given
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+            tmp.write(file_bytes)
+        futures = {}
+        try:
+            pool = self._get_ocr_pool()
+            if pool is not None:
+                for i in ocr_pages:
+                    futures[i] = pool.submit(timed_ocr_pdf_page, tmp.name, i + 1, self.ocr_dpi)
+            ocr_set = set(ocr_pages)
+            for i, text in enumerate(layer_texts):
+                if i in ocr_set:
+                    ocr_text = self._ocr_page(tmp.name, i + 1, futures.get(i))
+                    if ocr_text.strip():
+                        print(f"[OCR] Extracted {len(ocr_text)} chars from page {i+1}")
+                        text = ocr_text
+                    else:
+                        print(f"[OCR] No text found on page {i+1}")
                 else:
-                    print(f"[PDF] No text extracted from page {i+1}")
-            if not text.strip():
-                print("[PDF] No text extracted using PyPDF2, attempting OCR...")
-                try:
-                    pdf_bytes.seek(0)
-                    images = convert_from_bytes(pdf_bytes.read())
-                    for i, image in enumerate(images):
-                        try:
-                            ocr_text = pytesseract.image_to_string(image)
-                            if ocr_text:
-                                print(f"[OCR] Extracted {len(ocr_text)} chars from page {i+1}")
-                                text += ocr_text
-                            else:
-                                print(f"[OCR] No text found on page {i+1}")
-                        except Exception as e:
-                            print(f"Error performing OCR on page {i+1}: {str(e)}")
-                except Exception as e:
-                    print(f"OCR extraction failed: {str(e)}")
-            self.memory_cache[file_hash] = text
+                    print(f"[PDF] Extracted {len(text)} chars from page {i+1}")
+                yield text
+        finally:
+            for future in futures.values():
+                future.cancel()
+            os.unlink(tmp.name)
+
+    def extract_pages(self, file_bytes, doc_hash=None):
+        """Return the per-page texts of a PDF, served from the extraction cache when possible"""
+        doc_hash = doc_hash or content_hash(file_bytes)
+        pages = self.cache.get("pages", doc_hash)
+        if pages is not None:
+            print("[PDF] Using cached version.")
+            return pages
+        pages = list(self.iter_page_texts(file_bytes))
+        self.cache.put("pages", doc_hash, pages)
+        return pages
+
+    def extract_text_from_pdf(self, pdf_file):
+        try:
+            file_bytes = self.read_file_bytes(pdf_file)
+            text = "\n".join(page_text for page_text in self.extract_pages(file_bytes) if page_text)
             print(f"[PDF] Total extracted text length: {len(text)}")
             return text
         except Exception as e:
             print(f"PDF extraction failed: {str(e)}")
             return ""
 
-    def chunk_text(self, text, chunk_size=1000, overlap=200):
-        chunks = []
-        start = 0
-        while start < len(text):
-            end = start + chunk_size
-            chunk = text[start:end]
-            chunks.append(chunk)
-            start = end - overlap
-        return chunks
+    def iter_chunks(self, page_texts):
+        return self.chunker.iter_chunks(page_texts)
+
+    def chunk_text(self, text):
+        return list(self.iter_chunks([text]))
+
+    def create_embeddings(self, texts):
+        return self.embedding_service.embed(texts)
+
+    def process_document(self, file_bytes, doc_hash=None, progress=None):
+        """Extract, chunk and embed a PDF, embedding chunks while later pages are still being extracted.
+
+        `progress`, if given, is called with counter increments (pages=, chunks=, embedded=).
+        Returns (pages, chunks, embeddings).
+        """
+        progress = progress or (lambda **counts: None)
+        started = time.perf_counter()
+        timing = {'extract': 0.0}
+        doc_hash = doc_hash or content_hash(file_bytes)
+        chunk_key = f"{doc_hash}:{self.model_name}:{self.embedding_backend}:{self.chunker.max_tokens}:{self.chunker.overlap_segments}"
+        pages = self.cache.get("pages", doc_hash)
+        if pages is not None:
+            print("[PDF] Using cached version.")
+            cached = self.cache.get("chunks", chunk_key)
+            if cached is not None:
+                progress(pages=len(pages), chunks=len(cached['chunks']), embedded=len(cached['chunks']))
+                return pages, cached['chunks'], cached['embeddings']
+            progress(pages=len(pages))
+            page_iter = pages
+        else:
+            pages = []
+            page_iter = self._collect(self.iter_page_texts(file_bytes), pages, progress, timing)
+
+        def submit(batch):
+            future = self.embedding_service.submit(batch)
+            future.add_done_callback(lambda f: progress(embedded=0 if f.exception() else len(batch)))
+            return future
+
+        chunks, pending, futures = [], [], []
+        chunking_started = time.perf_counter()
+        for chunk in self.iter_chunks(page_iter):
+            chunks.append(chunk)
+            pending.append(chunk)
+            progress(chunks=1)
+            if len(pending) >= self.embedding_service.batch_size:
+                futures.append(submit(pending))
+                pending = []
+        if pending:
+            futures.append(submit(pending))
+        # Chunking is interleaved with extraction; the time spent producing pages is subtracted
+        size = document_size_label(len(pages))
+        metrics.observe('chunking_seconds', time.perf_counter() - chunking_started - timing['extract'], size=size)
+        metrics.increment('chunks_total', len(chunks))
+        embeddings = (
+            np.concatenate([future.result() for future in futures])
+            if futures else self.embedding_service.embed([])
+        )
+        print(f"[PDF] Total extracted text length: {sum(len(page) for page in pages)}")
+        self.cache.put("pages", doc_hash, pages)
+        self.cache.put("chunks", chunk_key, {'chunks': chunks, 'embeddings': embeddings})
+        metrics.observe('document_process_seconds', time.perf_counter() - started, size=size)
+        return pages, chunks, embeddings
+
+    @staticmethod
+    def _collect(iterable, sink, progress, timing):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                timing['extract'] += time.perf_counter() - start
+            sink.append(item)
+            progress(pages=1)
+            yield item
+
+# Vector Stores
+# "pinecone" (default) or "local" for the in-process NumPy index
+VECTOR_STORE = os.getenv("VECTOR_STORE", "pinecone")
+# Optional directory where the local index persists per-document matrices (memory-mapped on load)
+LOCAL_VECTOR_DIR = os.getenv("LOCAL_VECTOR_DIR", "")
+# Namespaces created by uploads and not queried or written for this long are deleted in the
+# background; reports loaded by ingest.py are kept
+VECTOR_NAMESPACE_TTL_HOURS = float(os.getenv("VECTOR_NAMESPACE_TTL_HOURS", "24"))
+VECTOR_CLEANUP_INTERVAL_SECONDS = float(os.getenv("VECTOR_CLEANUP_INTERVAL_SECONDS", "600"))
+# Each process refreshes a namespace's shared last-used time at most this often
+VECTOR_TOUCH_INTERVAL_SECONDS = 60
+
+# Upserts are split into batches below Pinecone's 2 MB request limit and sent concurrently
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "100"))
+UPSERT_MAX_BATCH_BYTES = int(os.getenv("UPSERT_MAX_BATCH_BYTES", str(1536 * 1024)))
+UPSERT_CONCURRENCY = int(os.getenv("UPSERT_CONCURRENCY", "4"))
+UPSERT_MAX_RETRIES = int(os.getenv("UPSERT_MAX_RETRIES", "3"))
+
+def document_namespace(doc_id):
+    """Each uploaded document (addressed by its content hash) lives in its own namespace"""
+    return f"doc-{doc_id}" if doc_id else ""
+
+VectorMatch = namedtuple('VectorMatch', ['id', 'score', 'metadata'])
+VectorQueryResult = namedtuple('VectorQueryResult', ['matches'])
+
+class VectorStore:
+    """Interface shared by the vector store backends.
+
+    Every document lives in its own namespace. Namespaces this store creates are deleted
+    by a background thread once unused for longer than the TTL; with no TTL they are
+    kept and no cleanup runs. Namespaces created elsewhere (bulk ingestion) never expire.
+    Last-used times are kept in the shared state backend when one is configured, so
+    every worker process expires namespaces on the same times.
+    """
+    def __init__(self, namespace_ttl=VECTOR_NAMESPACE_TTL_HOURS * 3600):
+        self.namespace_ttl = namespace_ttl
+        self._shared = create_state_store("namespaces") if namespace_ttl else None
+        # Last-used times, or with a shared backend when this process last wrote them
+        self._namespaces = {}
+        self._namespaces_lock = threading.Lock()
+
+    def document_vector_count(self, doc_id):
+        """Number of vectors already stored for a document, 0 if it has not been indexed"""
+        raise NotImplementedError
+
+    def upsert_vectors(self, vectors, texts, file_name, doc_id=None, progress=None):
+        """Store chunk vectors and return a dict with 'upserted', 'failed' and 'batches' counts.
+
+        `progress`, if given, is called with stored=<n> as batches complete.
+        """
+        raise NotImplementedError
+
+    def query_vectors(self, query_vector, top_k=3, doc_id=None):
+        """Return a result whose .matches carry .id, .score and .metadata['text']"""
+        raise NotImplementedError
+
+    def list_namespaces(self):
+        raise NotImplementedError
+
+    def delete_namespace(self, namespace):
+        raise NotImplementedError
+
+    def _last_used(self, namespace):
+        """Shared last-used time of a namespace, or None if no store created it"""
+        try:
+            raw = self._shared.get(namespace)
+            return float(raw) if raw is not None else None
+        except Exception as e:
+            print(f"[VectorStore] Reading last use of {namespace} failed: {str(e)}")
+            return None
+
+    def _set_last_used(self, namespace, now):
+        if self._shared is not None:
+            try:
+                self._shared.set(namespace, repr(now).encode())
+            except Exception as e:
+                print(f"[VectorStore] Recording use of {namespace} failed: {str(e)}")
+        with self._namespaces_lock:
+            self._namespaces[namespace] = now
+
+    def _track(self, namespace):
+        """Start the TTL of a namespace this store created"""
+        if self.namespace_ttl:
+            self._set_last_used(namespace, time.time())
+
+    def _touch(self, namespace):
+        if not self.namespace_ttl:
+            return
+        now = time.time()
+        with self._namespaces_lock:
+            last = self._namespaces.get(namespace)
+        if self._shared is None:
+            if last is not None:
+                self._set_last_used(namespace, now)
+            return
+        # The TTL is hours long: one shared write per process and interval is plenty
+        if last is not None and now - last < VECTOR_TOUCH_INTERVAL_SECONDS:
+            return
+        if last is None and self._last_used(namespace) is None:
+            return
+        self._set_last_used(namespace, now)
+
+    def _forget(self, namespace):
+        with self._namespaces_lock:
+            self._namespaces.pop(namespace, None)
+        if self._shared is not None:
+            try:
+                self._shared.delete(namespace)
+            except Exception as e:
+                print(f"[VectorStore] Forgetting {namespace} failed: {str(e)}")
+
+    def start_cleanup(self):
+        if not self.namespace_ttl:
+            return
+        threading.Thread(target=self._cleanup_loop, name="vector-namespace-cleanup", daemon=True).start()
+
+    def cleanup_stale_namespaces(self):
+        """Delete namespaces created by uploads that have not been used within the TTL"""
+        now = time.time()
+        if self._shared is not None:
+            # Any worker may have created or used a namespace; the shared times decide
+            stale = []
+            for namespace in self.list_namespaces():
+                last_used = self._last_used(namespace)
+                if last_used is not None and now - last_used > self.namespace_ttl:
+                    stale.append(namespace)
+        else:
+            with self._namespaces_lock:
+                stale = [ns for ns, last_used in self._namespaces.items() if now - last_used > self.namespace_ttl]
+        for namespace in stale:
+            try:
+                self.delete_namespace(namespace)
+                print(f"[VectorStore] Deleted stale namespace {namespace}")
+            except Exception as e:
+                print(f"[VectorStore] Error deleting namespace {namespace}: {str(e)}")
+        return len(stale)
+
+    def _cleanup_loop(self):
+        while True:
+            time.sleep(VECTOR_CLEANUP_INTERVAL_SECONDS)
+            try:
+                self.cleanup_stale_namespaces()
+            except Exception as e:
+                print(f"[VectorStore] Namespace cleanup failed: {str(e)}")
+
+# Pinecone Handler
+class PineconeHandler(VectorStore):
+    store_label = "pinecone"
+
+    def __init__(self, namespace_ttl=VECTOR_NAMESPACE_TTL_HOURS * 3600):
+        super().__init__(namespace_ttl)
+        from pinecone import Pinecone
+        self.pc = Pinecone(api_key=PINECONE_API_KEY)
+        self.index_name = "rag-documents"
+        self._upsert_pool = ThreadPoolExecutor(max_workers=UPSERT_CONCURRENCY, thread_name_prefix="pinecone-upsert")
+        self._ensure_index_exists()
+        if self.index is not None:
+            self.start_cleanup()
+
+    def _ensure_index_exists(self):
+        try:
+            existing_indexes = [idx.name for idx in self.pc.list_indexes()]
+            if self.index_name not in existing_indexes:
+                from pinecone import ServerlessSpec
+                self.pc.create_index(
+                    name=self.index_name,
+                    dimension=384,
+                    metric="cosine",
+                    spec=ServerlessSpec(cloud='aws', region='us-east-1')
+                )
+                # Wait for index to be ready
+                attempts = 0
+                while attempts < 10:
+                    time.sleep(2)
+                    if self.index_name in [idx.name for idx in self.pc.list_indexes()]:
+                        break
+                    attempts += 1
+            # Share one connection pool between the concurrent upsert batches
+            self.index = self.pc.Index(self.index_name, pool_threads=UPSERT_CONCURRENCY)
+        except Exception as e:
+            print(f"Error setting up Pinecone: {str(e)}")
+            # Create a dummy index for testing if Pinecone fails
+            self.index = None
+
+    def _namespace_counts(self):
+        stats = self.index.describe_index_stats()
+        return {name: summary.vector_count for name, summary in (stats.namespaces or {}).items()}
+
+    def document_vector_count(self, doc_id):
+        """Number of vectors already stored for a document, 0 if it has not been indexed"""
+        if self.index is None:
+            return 0
+        namespace = document_namespace(doc_id)
+        try:
+            count = self._namespace_counts().get(namespace, 0)
+        except Exception as e:
+            print(f"[Pinecone] Error reading index stats: {str(e)}")
+            return 0
+        if count:
+            self._touch(namespace)
+        return count
+
+    @staticmethod
+    def _batch_records(records):
+        """Split records into batches bounded by count and serialized size"""
+        batch, batch_bytes = [], 0
+        for record in records:
+            record_bytes = len(json.dumps(record))
+            if batch and (len(batch) >= UPSERT_BATCH_SIZE or batch_bytes + record_bytes > UPSERT_MAX_BATCH_BYTES):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(record)
+            batch_bytes += record_bytes
+        if batch:
+            yield batch
+
+    def _upsert_batch(self, batch, namespace):
+        """Upsert one batch with exponential-backoff retries; returns the number of vectors stored"""
+        for attempt in range(UPSERT_MAX_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                self.index.upsert(vectors=batch, namespace=namespace)
+                latency = time.perf_counter() - start
+                metrics.observe('vector_upsert_batch_seconds', latency, store=self.store_label)
+                print(f"[Pinecone] Upserted batch of {len(batch)} in {latency * 1000:.0f} ms")
+                return len(batch)
+            except Exception as e:
+                if attempt == UPSERT_MAX_RETRIES:
+                    print(f"Error upserting vectors: {str(e)}")
+                    return 0
+                metrics.increment('vector_upsert_retries_total', store=self.store_label)
+                delay = (2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"[Pinecone] Upsert attempt {attempt + 1} failed ({str(e)}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def upsert_vectors(self, vectors, texts, file_name, doc_id=None, progress=None):
+        """Store chunk vectors and return counts of stored and failed vectors"""
+        result = {'upserted': 0, 'failed': len(texts), 'batches': 0}
+        if self.index is None:
+            print("Pinecone index not available. Vector storage skipped.")
+            return result
+        namespace = document_namespace(doc_id)
+        timestamp = datetime.now().isoformat()
+        # Content-hash IDs make re-uploads of the same report idempotent
+        records = [
+            {
+                "id": content_hash(text),
+                "values": np.asarray(vector, dtype=np.float32).tolist(),
+                "metadata": {
+                    "text": text,
+                    "source": file_name,
+                    "timestamp": timestamp
+                }
+            }
+            for vector, text in zip(vectors, texts)
+        ]
+        start = time.perf_counter()
+        batches = list(self._batch_records(records))
+        futures = [self._upsert_pool.submit(self._upsert_batch, batch, namespace) for batch in batches]
+        if progress is not None:
+            for future in futures:
+                future.add_done_callback(lambda f: progress(stored=f.result()))
+        upserted = sum(future.result() for future in futures)
+        if upserted:
+            self._track(namespace)
+        metrics.observe('vector_upsert_seconds', time.perf_counter() - start, store=self.store_label)
+        metrics.increment('vectors_upserted_total', upserted, store=self.store_label)
+        metrics.increment('vectors_failed_total', len(records) - upserted, store=self.store_label)
+        result.update(upserted=upserted, failed=len(records) - upserted, batches=len(batches))
+        return result
+
+    def query_vectors(self, query_vector, top_k=3, doc_id=None):
+        if self.index is None:
+            return VectorQueryResult([])
+        namespace = document_namespace(doc_id)
+        try:
+            with metrics.time('vector_query_seconds', store=self.store_label):
+                results = self.index.query(
+                    vector=np.asarray(query_vector, dtype=np.float32).tolist(),
+                    top_k=top_k,
+                    include_metadata=True,
+                    namespace=namespace
+                )
+            self._touch(namespace)
+            return results
+        except Exception as e:
+            print(f"Error querying vectors: {str(e)}")
+            metrics.increment('vector_query_errors_total', store=self.store_label)
+            return VectorQueryResult([])
+
+    def list_namespaces(self):
+        return list(self._namespace_counts())
+
+    def delete_namespace(self, namespace):
+        self.index.delete(delete_all=True, namespace=namespace)
+        self._forget(namespace)
+
+# Local Vector Store
+class LocalVectorStore(VectorStore):
+    """In-process vector index: one float32 matrix per document namespace with vectorized cosine top-k.
+
+    With a persist_dir, a cached namespace is reloaded when its file was replaced, so workers
+    (and the bulk ingester) sharing the directory see each other's writes and deletes.
+    """
+    store_label = "local"
+
+    def __init__(self, persist_dir=LOCAL_VECTOR_DIR, namespace_ttl=VECTOR_NAMESPACE_TTL_HOURS * 3600):
+        super().__init__(namespace_ttl)
+        self.persist_dir = persist_dir
+        self._docs = {}
+        self._docs_lock = threading.Lock()
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+        self.start_cleanup()
+
+    def _paths(self, namespace):
+        base = os.path.join(self.persist_dir, namespace)
+        return base + ".npy", base + ".json"
+
+    @staticmethod
+    def _file_version(path):
+        """Identity of the file now at `path` (a rename gives a new inode), or None if there is none"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _load(self, namespace):
+        doc = self._docs.get(namespace)
+        if not self.persist_dir:
+            return doc
+        matrix_path, meta_path = self._paths(namespace)
+        version = self._file_version(matrix_path)
+        if version is None:
+            # Never stored, or deleted by another worker's cleanup
+            if doc is not None:
+                with self._docs_lock:
+                    self._docs.pop(namespace, None)
+            return None
+        if doc is not None and doc.get('version') == version:
+            return doc
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            matrix = np.load(matrix_path, mmap_mode='r')
+            if len(meta['ids']) != len(matrix):
+                raise ValueError("matrix and metadata are from different writes")
+            doc = {'matrix': matrix, 'ids': meta['ids'], 'metadata': meta['metadata'], 'version': version}
+        except Exception as e:
+            print(f"[LocalVectorStore] Error loading {namespace}: {str(e)}")
+            return doc
+        with self._docs_lock:
+            self._docs[namespace] = doc
+        return doc
+
+    def _save(self, namespace, doc):
+        """Write through temporary files and renames, so other workers never read a half-written namespace"""
+        matrix_path, meta_path = self._paths(namespace)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(meta_path + suffix, "w", encoding="utf-8") as f:
+            json.dump({'ids': doc['ids'], 'metadata': doc['metadata']}, f)
+        with open(matrix_path + suffix, "wb") as f:
+            np.save(f, np.asarray(doc['matrix']))
+        os.replace(meta_path + suffix, meta_path)
+        os.replace(matrix_path + suffix, matrix_path)
+        doc['version'] = self._file_version(matrix_path)
+
+    def document_vector_count(self, doc_id):
+        namespace = document_namespace(doc_id)
+        doc = self._load(namespace)
+        if doc is None:
+            return 0
+        self._touch(namespace)
+        return len(doc['ids'])
+
+    def upsert_vectors(self, vectors, texts, file_name, doc_id=None, progress=None):
+        if not texts:
+            return {'upserted': 0, 'failed': 0, 'batches': 0}
+        start = time.perf_counter()
+        namespace = document_namespace(doc_id)
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1, norms)
+        timestamp = datetime.now().isoformat()
+        existing = self._load(namespace)
+        with self._docs_lock:
+            rows = {}
+            if existing is not None:
+                for i, vector_id in enumerate(existing['ids']):
+                    rows[vector_id] = (existing['matrix'][i], existing['metadata'][i])
+            for vector, text in zip(matrix, texts):
+                rows[content_hash(text)] = (vector, {"text": text, "source": file_name, "timestamp": timestamp})
+            ids = list(rows)
+            doc = {
+                'matrix': np.stack([rows[vector_id][0] for vector_id in ids]).astype(np.float32),
+                'ids': ids,
+                'metadata': [rows[vector_id][1] for vector_id in ids],
+            }
+            self._docs[namespace] = doc
+        if self.persist_dir:
+            self._save(namespace, doc)
+        self._track(namespace)
+        if progress is not None:
+            progress(stored=len(texts))
+        metrics.observe('vector_upsert_seconds', time.perf_counter() - start, store=self.store_label)
+        metrics.increment('vectors_upserted_total', len(texts), store=self.store_label)
+        return {'upserted': len(texts), 'failed': 0, 'batches': 1}
+
+    def query_vectors(self, query_vector, top_k=3, doc_id=None):
+        namespace = document_namespace(doc_id)
+        doc = self._load(namespace)
+        if doc is None or not doc['ids']:
+            return VectorQueryResult([])
+        self._touch(namespace)
+        start = time.perf_counter()
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        scores = doc['matrix'] @ query
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        metrics.observe('vector_query_seconds', time.perf_counter() - start, store=self.store_label)
+        return VectorQueryResult([
+            VectorMatch(doc['ids'][i], float(scores[i]), doc['metadata'][i]) for i in top
+        ])
+
+    def list_namespaces(self):
+        if not self.persist_dir:
+            return list(self._docs)
+        # The directory, not this worker's cache, knows what other workers stored and deleted
+        return [name[:-4] for name in os.listdir(self.persist_dir) if name.endswith(".npy")]
+
+    def delete_namespace(self, namespace):
+        with self._docs_lock:
+            self._docs.pop(namespace, None)
+        if self.persist_dir:
+            for path in self._paths(namespace):
+                if os.path.exists(path):
+                    os.remove(path)
+        self._forget(namespace)
+
+def create_vector_store():
+    """Build the configured vector store, falling back to the local index when Pinecone is unreachable"""
+    if VECTOR_STORE == "local":
+        print("[VectorStore] Using the local in-process vector store")
+        return LocalVectorStore()
+    handler = PineconeHandler()
+    if handler.index is None:
+        print("[VectorStore] Pinecone unavailable, falling back to the local in-process vector store")
+        return LocalVectorStore()
+    return handler
+
+# Hybrid Retrieval
+# Chunks passed to Gemini after fusion, and candidates taken from each retriever
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "10"))
+# Upper bound on the estimated tokens of report context put in the prompt
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "1000"))
+# Reciprocal rank fusion constant; larger values flatten the weight of top ranks
+RRF_K = 60
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Words, lab codes (HbA1c, T4) and decimal values (7.2) are kept as single terms
+KEYWORD_TERM = re.compile(r'\d+(?:\.\d+)?|[^\W\d_]\w*')
+KEYWORD_STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'do', 'does', 'for', 'from', 'how', 'i', 'in', 'is',
+    'it', 'me', 'my', 'of', 'on', 'or', 'should', 'that', 'the', 'this', 'to', 'was', 'what', 'which', 'with', 'you', 'your',
+}
+
+def keyword_terms(text):
+    return [term for term in KEYWORD_TERM.findall(text.lower()) if term not in KEYWORD_STOPWORDS]
+
+class BM25Index:
+    """Okapi BM25 inverted index over the chunks of one document"""
+    def __init__(self, chunks, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.ids = [content_hash(chunk) for chunk in chunks]
+        self.texts = list(chunks)
+        self.postings = {}
+        self.lengths = []
+        for position, chunk in enumerate(chunks):
+            terms = keyword_terms(chunk)
+            self.lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append((position, count))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        total = len(self.texts)
+        self.idf = {
+            term: float(np.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5)))
+            for term, postings in self.postings.items()
+        }
+
+    def search(self, query, top_k=RETRIEVAL_CANDIDATES):
+        """Return [(chunk position, score)] for the best matching chunks, best first"""
+        scores = {}
+        for term in set(keyword_terms(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for position, count in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / (self.avg_length or 1))
+                scores[position] = scores.get(position, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        return sorted(scores.items(), key=lambda item: -item[1])[:top_k]
+
+# Only the chunk texts are stored; the index is rebuilt from them in a few milliseconds
+ExtractionCache.codecs['keywords'] = (lambda index: index.texts, BM25Index)
+
+def fuse_rankings(rankings, rrf_k=RRF_K):
+    """Reciprocal rank fusion of several best-first lists of chunk IDs"""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank + 1)
+    return sorted(scores, key=lambda chunk_id: -scores[chunk_id])
+
+def keyword_index(doc_id):
+    """The document's BM25 index from the extraction cache, or None if it is not available"""
+    return services.doc_processor.cache.get("keywords", doc_id)
+
+def retrieve_context(query, query_vector, doc_id, top_k=RETRIEVAL_TOP_K, max_tokens=CONTEXT_MAX_TOKENS):
+    """Fuse dense and BM25 results and pack the best chunks into a token-bounded context.
+
+    Returns (context, info) where info counts the candidates and the chunks and tokens used.
+    """
+    start = time.perf_counter()
+    dense = services.vector_store.query_vectors(query_vector, top_k=RETRIEVAL_CANDIDATES, doc_id=doc_id)
+    texts = {match.id: match.metadata['text'] for match in dense.matches}
+    rankings = [[match.id for match in dense.matches]]
+    index = keyword_index(doc_id)
+    keyword_hits = index.search(query) if index is not None else []
+    if keyword_hits:
+        rankings.append([index.ids[position] for position, _ in keyword_hits])
+        texts.update((index.ids[position], index.texts[position]) for position, _ in keyword_hits)
+
+    selected, tokens = [], 0
+    for chunk_id in fuse_rankings(rankings)[:top_k]:
+        chunk_tokens = estimate_tokens(texts[chunk_id])
+        # The best chunk is always kept; later ones only while they fit the budget
+        if selected and tokens + chunk_tokens > max_tokens:
+            break
+        selected.append(texts[chunk_id])
+        tokens += chunk_tokens
+    metrics.observe('retrieval_seconds', time.perf_counter() - start, keyword='yes' if index is not None else 'no')
+    info = {'dense': len(dense.matches), 'keyword': len(keyword_hits), 'chunks': len(selected), 'tokens': tokens}
+    return "\n".join(selected), info
+
+# Lab Values
+# Answer direct questions about a test's value from the parsed lab table without calling Gemini
+LAB_FAST_PATH_ENABLED = os.getenv("LAB_FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# "Hemoglobin    14.2  H  g/dL    13.0 - 17.0", "TSH: 5.2 uIU/mL (0.4-4.0)", "LDL | 130 | mg/dL | < 100",
+# and "Hemoglobin 11.2 g/dL 13.0 - 17.0" as PyPDF2 extracts table cells (single spaces)
+LAB_ROW = re.compile(r"""
+    ^\s*(?P<name>[A-Za-z][A-Za-z0-9 ,()/'.+-]*?[A-Za-z0-9)])\s*(?::|\t|\||\s)\s*
+    (?P<value>[<>]?\s*\d+(?:\.\d+)?)\s*
+    (?:(?P<flag>H|L|High|Low|HIGH|LOW)\b\s*)?\|?\s*
+    (?P<unit>(?:10\^\d+/)?[A-Za-z%µμ][^\s()|]*)?\s*\|?\s*
+    (?:\(?\s*(?:Ref(?:erence)?\.?\s*:?\s*)?(?P<range>\d+(?:\.\d+)?\s*[-–]\s*\d+(?:\.\d+)?|[<>]=?\s*\d+(?:\.\d+)?|(?:up\s*to)\s*\d+(?:\.\d+)?)\s*\)?)?\s*$
+""", re.VERBOSE | re.IGNORECASE)
+LAB_NUMBER = re.compile(r'\d+(?:\.\d+)?')
+# Column separators that mark a table row by themselves; a single space only counts before a unit like these
+LAB_COLUMN_SEPARATOR = re.compile(r':|\t|\||\s{2,}')
+LAB_UNIT = re.compile(r'%|\S*/\S+|fl|pg|iu|u|secs?|ratio', re.IGNORECASE)
+# A number standing on its own in a test name: "Sample ID 12345", or "Collected 10" cut from a time like "10:30"
+LAB_NAME_NUMBER = re.compile(r'(?:^|\s)\d+(?:\.\d+)?(?=\s|$)')
+# Words shared by many test names ("Total Leukocyte Count", "Serum Creatinine") that identify none of them
+LAB_NAME_STOPWORDS = {'blood', 'count', 'total', 'serum', 'plasma', 'level', 'levels', 'test', 'value', 'result'}
+# Everyday words patients use for tests, mapped to terms found in report test names
+LAB_ALIASES = {
+    'sugar': 'glucose', 'hb': 'hemoglobin', 'haemoglobin': 'hemoglobin', 'thyroid': 'tsh',
+    'platelets': 'platelet', 'wbc': 'leukocyte', 'rbc': 'red', 'cholestrol': 'cholesterol',
+    'vit': 'vitamin', 'a1c': 'hba1c', 'bilirubine': 'bilirubin', 'creatinin': 'creatinine',
+}
+# Questions that ask for an explanation or advice rather than a value
+LAB_EXPLANATION_CUES = re.compile(
+    r"\b(why|explain|mean|means|meaning|cause|causes|should|improve|reduce|increase|lower|diet|food|eat|"
+    r"treat|treatment|medicine|dangerous|serious|worried|risk|kyu|kyon|matlab|kaise)\b|क्यों|मतलब|कारण|कैसे|क्या करें",
+    re.IGNORECASE
+)
+
+LabResult = namedtuple('LabResult', ['name', 'value', 'unit', 'low', 'high', 'status'])
+
+def parse_lab_range(text):
+    """Return (low, high) bounds of a reference range such as "13.0 - 17.0", "< 100" or "up to 40" """
+    if not text:
+        return None, None
+    numbers = [float(number) for number in LAB_NUMBER.findall(text)]
+    if len(numbers) >= 2:
+        return numbers[0], numbers[1]
+    if text.lstrip().startswith('>'):
+        return numbers[0], None
+    return None, numbers[0]
+
+def parse_lab_line(line):
+    """Parse one report line into a LabResult, or None if it is not a result row"""
+    match = LAB_ROW.match(line)
+    if not match or not (match.group('unit') or match.group('range')):
+        return None
+    # "Repeat the test in 3 months" is prose, "Hemoglobin 11.2 g/dL" is a row
+    known_unit = LAB_UNIT.fullmatch(match.group('unit') or '')
+    if not known_unit and not LAB_COLUMN_SEPARATOR.search(line[match.end('name'):match.start('value')]):
+        return None
+    # "Time 09:15 hrs" is split at the colon of a time, not at a column
+    if not known_unit and not match.group('range'):
+        return None
+    if LAB_NAME_NUMBER.search(match.group('name')):
+        return None
+    value = float(LAB_NUMBER.search(match.group('value')).group())
+    low, high = parse_lab_range(match.group('range'))
+    flag = (match.group('flag') or '').lower()
+    if low is not None and value < low:
+        status = 'low'
+    elif high is not None and value > high:
+        status = 'high'
+    elif low is not None or high is not None:
+        status = 'normal'
+    else:
+        status = {'h': 'high', 'high': 'high', 'l': 'low', 'low': 'low'}.get(flag)
+    return LabResult(" ".join(match.group('name').split()), value, match.group('unit') or "", low, high, status)
+
+def lab_name_terms(name):
+    """Terms that can identify a test: no generic words ("blood", "total") and no numbers"""
+    return {term for term in keyword_terms(name) if term not in LAB_NAME_STOPWORDS and not term[0].isdigit()}
+
+class LabTable:
+    """Test name / value / unit / reference range rows parsed from one report"""
+    def __init__(self, results):
+        self.results = list(results)
+        self._terms = [lab_name_terms(result.name) for result in self.results]
+        counts = {}
+        for terms in self._terms:
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+        # Rare name terms ("d" in "Vitamin D") identify a test better than shared ones ("vitamin")
+        self._weights = {term: float(np.log(1 + len(self.results) / count)) for term, count in counts.items()}
+
+    @classmethod
+    def from_pages(cls, pages):
+        results = {}
+        for page in pages:
+            for line in page.splitlines():
+                result = parse_lab_line(line)
+                if result is not None:
+                    results.setdefault(result.name.lower(), result)
+        return cls(results.values())
+
+    def __len__(self):
+        return len(self.results)
+
+    def find(self, query):
+        """Rows whose test name is mentioned in the query, best matches only"""
+        terms = set(keyword_terms(query))
+        terms = lab_name_terms(" ".join(terms | {LAB_ALIASES[term] for term in terms if term in LAB_ALIASES}))
+        scored = []
+        for result, name_terms in zip(self.results, self._terms):
+            score = sum(self._weights[term] for term in name_terms & terms)
+            if score:
+                scored.append((score, result))
+        if not scored:
+            return []
+        # "Vitamin D" should not also return Vitamin B12 through the shared word
+        best = max(score for score, _ in scored)
+        return [result for score, result in sorted(scored, key=lambda item: -item[0]) if score >= 0.8 * best]
+
+ExtractionCache.codecs['labs'] = (
+    lambda table: [list(result) for result in table.results],
+    lambda rows: LabTable(LabResult(*row) for row in rows),
+)
+
+def format_lab_result(result):
+    """Compact one-line form used both as prompt context and in fast-path answers"""
+    value = f"{result.value:g} {result.unit}".strip()
+    if result.low is not None and result.high is not None:
+        reference = f"reference {result.low:g}-{result.high:g}"
+    elif result.high is not None:
+        reference = f"reference below {result.high:g}"
+    elif result.low is not None:
+        reference = f"reference above {result.low:g}"
+    else:
+        reference = "no reference range given"
+    status = {'low': "below the normal range", 'high': "above the normal range", 'normal': "within the normal range"}.get(result.status)
+    return f"{result.name}: {value} ({reference})" + (f", {status}" if status else "")
+
+def store_document_indexes(cache, doc_id, pages, chunks):
+    """Build the keyword index and lab table of a document and keep them with its other cached artefacts"""
+    cache.put("keywords", doc_id, BM25Index(chunks))
+    labs = LabTable.from_pages(pages)
+    cache.put("labs", doc_id, labs)
+    print(f"[Labs] Parsed {len(labs)} lab results")
+
+def lab_table(doc_id):
+    """The document's parsed lab table from the extraction cache, or None if it is not available"""
+    return services.doc_processor.cache.get("labs", doc_id)
+
+def is_lab_value_lookup(query, results):
+    """A short question about one clearly identified test that asks for no explanation or advice"""
+    return len(results) == 1 and len(query.split()) <= 12 and not LAB_EXPLANATION_CUES.search(query)
+
+def lab_lookup_answer(results):
+    lines = ["Here is what your report shows:"]
+    lines.extend(f"- {format_lab_result(result)}." for result in results)
+    lines.append("Please discuss these results with your doctor; this is not a substitute for professional medical advice.")
+    return "\n".join(lines)
+
+# Chat Sessions
+MAX_CHAT_SESSIONS = int(os.getenv("MAX_CHAT_SESSIONS", "1000"))
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "3600"))
+# Conversation history resent to Gemini is windowed to roughly this many tokens
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "1500"))
+# Questions from dropped turns kept in the running summary
+HISTORY_SUMMARY_QUESTIONS = 5
+# Shared session records are counted for the live-sessions gauge at most this often
+SESSION_COUNT_INTERVAL_SECONDS = 30
+
+def estimate_tokens(text):
+    """Cheap token estimate (about four characters per token) for budgeting prompts"""
+    return max(1, len(text) // 4)
+
+def new_session_record(now=0.0):
+    return {'turns': deque(), 'summary': [], 'tokens': 0, 'last_active': now, 'document': None}
+
+class ChatSessionStore:
+    """Per-user session state: the registered report and the conversation, kept in process
+    memory with max-session LRU eviction and an idle TTL.
+
+    Only the user's question and the answer are kept per turn (not the retrieved
+    context), and the history is windowed to a token budget. Dropped turns are
+    folded into a short summary of what was asked earlier.
+    """
+    def __init__(self, max_sessions=MAX_CHAT_SESSIONS, idle_ttl=SESSION_IDLE_TTL_SECONDS,
+                 history_max_tokens=HISTORY_MAX_TOKENS):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.history_max_tokens = history_max_tokens
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self._register_gauges()
+
+    def _register_gauges(self):
+        metrics.register_gauge('chat_sessions_live', lambda: self.stats()['live_sessions'])
+        metrics.register_gauge('chat_history_tokens_avg', lambda: self.stats()['avg_history_tokens'])
+
+    def _evict(self, session_id):
+        # Caller holds the lock
+        self._sessions.pop(session_id, None)
+        self.evictions += 1
+
+    @contextmanager
+    def _edit(self, session_id):
+        """Yield the session record for reading or in-place changes"""
+        with self._lock:
+            # Expired sessions sit at the front of the LRU order
+            now = time.monotonic()
+            while self._sessions:
+                oldest_id, oldest = next(iter(self._sessions.items()))
+                if now - oldest['last_active'] <= self.idle_ttl:
+                    break
+                self._evict(oldest_id)
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = new_session_record(now)
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._evict(next(iter(self._sessions)))
+            session['last_active'] = now
+            self._sessions.move_to_end(session_id)
+            yield session
+
+    def document(self, session_id):
+        """The report registered for the session, or None"""
+        with self._edit(session_id) as session:
+            return session['document']
+
+    def set_document(self, session_id, document):
+        """Register a report; a new report starts a new conversation"""
+        with self._edit(session_id) as session:
+            session['document'] = document
+            session['turns'].clear()
+            session['summary'] = []
+            session['tokens'] = 0
+
+    def history(self, session_id):
+        """Gemini chat history for the session, starting with the summary of dropped turns"""
+        with self._edit(session_id) as session:
+            history = []
+            if session['summary']:
+                history.append({'role': 'user', 'parts': [
+                    "Earlier in this conversation I asked about: " + "; ".join(session['summary'])
+                ]})
+                history.append({'role': 'model', 'parts': ["Understood."]})
+            for query, answer, _ in session['turns']:
+                history.append({'role': 'user', 'parts': [query]})
+                history.append({'role': 'model', 'parts': [answer]})
+            return history
+
+    def record_turn(self, session_id, query, answer):
+        with self._edit(session_id) as session:
+            tokens = estimate_tokens(query) + estimate_tokens(answer)
+            session['turns'].append((query, answer, tokens))
+            session['tokens'] += tokens
+            while len(session['turns']) > 1 and session['tokens'] > self.history_max_tokens:
+                dropped_query, _, dropped_tokens = session['turns'].popleft()
+                session['tokens'] -= dropped_tokens
+                session['summary'] = (session['summary'] + [dropped_query[:200]])[-HISTORY_SUMMARY_QUESTIONS:]
+
+    def stats(self):
+        with self._lock:
+            live = len(self._sessions)
+            total_tokens = sum(session['tokens'] for session in self._sessions.values())
+            return {
+                'live_sessions': live,
+                'avg_history_tokens': total_tokens / live if live else 0.0,
+                'evictions': self.evictions,
+            }
+
+class SharedChatSessionStore(ChatSessionStore):
+    """Session state in a shared store, so any worker process can serve any request.
+
+    Each session is one JSON record whose expiry is pushed back by the idle TTL whenever it
+    changes; the store's expiry replaces the in-process LRU. Each read-modify-write holds the
+    store's lock on the record, so concurrent requests in different processes keep every turn.
+    """
+    def __init__(self, state, idle_ttl=SESSION_IDLE_TTL_SECONDS, history_max_tokens=HISTORY_MAX_TOKENS):
+        self.state = state
+        self._live_sessions = 0
+        self._counted_at = float('-inf')
+        super().__init__(idle_ttl=idle_ttl, history_max_tokens=history_max_tokens)
+
+    def _register_gauges(self):
+        # History sizes live inside the session records; only the record count is cheap to read
+        metrics.register_gauge('chat_sessions_live', self.live_sessions)
+
+    def live_sessions(self):
+        """Session record count, re-counted at most every SESSION_COUNT_INTERVAL_SECONDS (a key scan on Redis)"""
+        now = time.monotonic()
+        if now - self._counted_at >= SESSION_COUNT_INTERVAL_SECONDS:
+            self._live_sessions = self.stats().get('keys', self._live_sessions)
+            self._counted_at = now
+        return self._live_sessions
+
+    @staticmethod
+    def _encode(session):
+        record = dict(session, turns=list(session['turns']))
+        return json.dumps(record, ensure_ascii=False).encode('utf-8')
+
+    @contextmanager
+    def _edit(self, session_id):
+        key = f"session:{session_id}"
+        with self.state.locked(key):
+            session = None
+            try:
+                raw = self.state.get(key)
+                if raw is not None:
+                    session = json.loads(raw)
+                    session['turns'] = deque(tuple(turn) for turn in session['turns'])
+            except Exception as e:
+                print(f"[Sessions] Reading session {session_id} failed: {str(e)}")
+            if session is None:
+                session = new_session_record()
+            before = self._encode(session)
+            yield session
+            try:
+                # Reads leave the record (and its expiry) alone, and unknown sessions are not created
+                record = self._encode(session)
+                if record != before:
+                    self.state.set(key, record, ttl=self.idle_ttl)
+            except Exception as e:
+                print(f"[Sessions] Saving session {session_id} failed: {str(e)}")
+
+    def stats(self):
+        try:
+            return self.state.stats()
+        except Exception as e:
+            return {'backend': self.state.backend, 'error': str(e)}
+
+def create_chat_session_store():
+    state = create_state_store("sessions")
+    if state is None:
+        return ChatSessionStore()
+    print(f"[Sessions] Keeping session state in {state.backend}")
+    return SharedChatSessionStore(state)
+
+# Resilience
+# Calls to Gemini and Google Translate pass through admission control per upstream: a token
+# bucket (requests per second, 0 = unlimited), a cap on calls in flight with a bounded wait
+# queue (callers beyond it are refused at once), a circuit breaker and jittered retries
+GEMINI_RATE_PER_SECOND = float(os.getenv("GEMINI_RATE_PER_SECOND", "0"))
+# One Gemini slot per chat slot, so a healthy but slow Gemini still serves every admitted chat;
+# a failing one is shed by its circuit breaker and the wait limit. The queue absorbs bursts from other callers
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", str(MAX_CONCURRENT_CHATS)))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", str(max(1, MAX_CONCURRENT_CHATS // 4))))
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60"))
+TRANSLATION_RATE_PER_SECOND = float(os.getenv("TRANSLATION_RATE_PER_SECOND", "0"))
+TRANSLATION_MAX_IN_FLIGHT = int(os.getenv("TRANSLATION_MAX_IN_FLIGHT", "16"))
+TRANSLATION_MAX_QUEUE = int(os.getenv("TRANSLATION_MAX_QUEUE", "64"))
+# Send a second translation request when the first has not answered within this time (0 disables)
+TRANSLATION_HEDGE_AFTER_SECONDS = float(os.getenv("TRANSLATION_HEDGE_AFTER_SECONDS", "2"))
+# Longest a call may wait for a rate token plus an in-flight slot before it is shed
+UPSTREAM_MAX_WAIT_SECONDS = float(os.getenv("UPSTREAM_MAX_WAIT_SECONDS", "5"))
+# Consecutive failures that open a circuit, and how long it stays open before one trial call
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "2"))
+UPSTREAM_RETRY_BASE_SECONDS = 0.25
+
+class UpstreamUnavailable(Exception):
+    """A call was refused without reaching the upstream: circuit open or load shed"""
+    def __init__(self, upstream, reason):
+        super().__init__(f"{upstream} unavailable ({reason})")
+        self.upstream = upstream
+        self.reason = reason
+
+class TokenBucket:
+    """Requests-per-second limiter; a reservation books the next token ahead of time"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """Seconds until the booked token is due, or None (nothing booked) if that exceeds max_wait"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+class Bulkhead:
+    """Caps calls in flight. Up to `max_queue` callers wait in FIFO order for a slot; the rest are refused.
+
+    A released slot is handed directly to the oldest waiter, which is woken through its
+    event loop (the slot may be released from another thread).
+    """
+    def __init__(self, max_in_flight, max_queue):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def _enter(self, waiter):
+        """True if a slot was taken, False if queued, None if the queue is full"""
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._waiters:
+                self.in_flight += 1
+                return True
+            if len(self._waiters) >= self.max_queue:
+                return None
+            self._waiters.append(waiter)
+            return False
+
+    def _withdraw(self, waiter):
+        """Stop waiting; True if the slot had already been handed over"""
+        with self._lock:
+            if waiter['granted']:
+                return True
+            self._waiters.remove(waiter)
+            return False
+
+    async def acquire_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        wake = lambda: future.done() or future.set_result(None)
+        waiter = {'granted': False, 'wake': lambda: loop.call_soon_threadsafe(wake)}
+        entered = self._enter(waiter)
+        if entered is None:
+            return 'queue_full'
+        if entered:
+            return None
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None if self._withdraw(waiter) else 'wait_timeout'
+        except asyncio.CancelledError:
+            if self._withdraw(waiter):
+                self.release()
+            raise
+        return None
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter['granted'] = True
+            else:
+                self.in_flight -= 1
+                return
+        waiter['wake']()
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures and refuses calls for `reset_seconds`,
+    then lets a single trial call through (half-open) and closes again if it succeeds
+    """
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_seconds=CIRCUIT_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Whether a call would be let through right now (without claiming the half-open trial)"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self._opened_at >= self.reset_seconds
+            return self.state == self.CLOSED or not self._trial_in_flight
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_in_flight = False
+            if self.state != self.CLOSED:
+                print(f"[Resilience] {self.name} circuit closed")
+                self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                print(f"[Resilience] {self.name} circuit opened after {self.failures} consecutive failures")
+                metrics.increment('upstream_circuit_opened_total', upstream=self.name)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
 
-    def create_embeddings(self, texts):
-        embeddings = self.model.encode(texts).tolist()
-        return embeddings
+    def abandon(self):
+        """A call ended without an outcome (cancelled); free the half-open trial"""
+        with self._lock:
+            self._trial_in_flight = False
 
-# Pinecone Handler
-class PineconeHandler:
-    def __init__(self):
-        self.pc = Pinecone(api_key=PINECONE_API_KEY)
-        self.index_name = "rag-documents"
-        self._ensure_index_exists()
+class Upstream:
+    """Admission control, retries and hedging for one outbound dependency.
 
-    def _ensure_index_exists(self):
-        try:
-            existing_indexes = [idx.name for idx in self.pc.list_indexes()]
-            if self.index_name not in existing_indexes:
-                self.pc.create_index(
-                    name=self.index_name,
-                    dimension=384,
-                    metric="cosine",
-                    spec=ServerlessSpec(cloud='aws', region='us-east-1')
-                )
-                # Wait for index to be ready
-                attempts = 0
-                while attempts < 10:
-                    time.sleep(2)
-                    if self.index_name in [idx.name for idx in self.pc.list_indexes()]:
-                        break
-                    attempts += 1
-            self.index = self.pc.Index(self.index_name)
-        except Exception as e:
-            print(f"Error setting up Pinecone: {str(e)}")
-            # Create a dummy index for testing if Pinecone fails
-            self.index = None
+    Every attempt takes a rate token and an in-flight slot and passes the circuit breaker;
+    attempts that would wait longer than `max_wait` for those are shed with UpstreamUnavailable.
+    Only errors accepted by `transient` are retried and count against the breaker; other
+    errors mean the upstream answered and are passed straight to the caller.
+    """
+    def __init__(self, name, rate, max_in_flight, max_queue, max_wait=UPSTREAM_MAX_WAIT_SECONDS,
+                 max_retries=UPSTREAM_MAX_RETRIES, hedge_after=0.0, transient=None):
+        self.name = name
+        self.bucket = TokenBucket(rate)
+        self.bulkhead = Bulkhead(max_in_flight, max_queue)
+        self.breaker = CircuitBreaker(name)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.transient = transient or (lambda error: True)
+        metrics.register_gauge('upstream_in_flight', lambda: self.bulkhead.in_flight, upstream=name)
+        metrics.register_gauge('upstream_queue_depth', lambda: self.bulkhead.queued, upstream=name)
+        metrics.register_gauge(
+            'upstream_circuit_state', lambda: CircuitBreaker.STATE_VALUES[self.breaker.state], upstream=name
+        )
 
-    def upsert_vectors(self, vectors, texts, file_name, doc_id=None):
-        if self.index is None:
-            print("Pinecone index not available. Vector storage skipped.")
-            return
+    def available(self):
+        """False when a new call would be refused right away, so callers can shed work early"""
+        return self.breaker.available() and self.bulkhead.queued < self.bulkhead.max_queue
+
+    def _shed(self, reason):
+        metrics.increment('upstream_shed_total', upstream=self.name, reason=reason)
+        return UpstreamUnavailable(self.name, reason)
+
+    def _admitted(self, start):
+        # Caller holds an in-flight slot
+        if not self.breaker.allow():
+            self.bulkhead.release()
+            raise self._shed('circuit_open')
+        metrics.observe('upstream_admission_wait_seconds', time.perf_counter() - start, upstream=self.name)
+
+    def _finish(self, error):
+        self.bulkhead.release()
+        if error is None:
+            self.breaker.record_success()
+            outcome = 'success'
+        elif not isinstance(error, Exception):
+            self.breaker.abandon()
+            outcome = 'cancelled'
+        elif self.transient(error):
+            self.breaker.record_failure()
+            outcome = 'failure'
+        else:
+            self.breaker.record_success()
+            outcome = 'rejected'
+        metrics.increment('upstream_calls_total', upstream=self.name, outcome=outcome)
+
+    @asynccontextmanager
+    async def admit_async(self):
+        if not self.breaker.available():
+            raise self._shed('circuit_open')
+        start = time.perf_counter()
+        wait = self.bucket.reserve(self.max_wait)
+        if wait is None:
+            raise self._shed('rate_limited')
+        if wait:
+            await asyncio.sleep(wait)
+        refused = await self.bulkhead.acquire_async(self.max_wait - wait)
+        if refused:
+            raise self._shed(refused)
+        self._admitted(start)
         try:
-            vectors_to_upsert = [
-                {
-                    "id": f"{file_name}_{i}",
-                    "values": vector,
-                    "metadata": {
-                        "text": text,
-                        "source": file_name,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                }
-                for i, (vector, text) in enumerate(zip(vectors, texts))
-            ]
-            self.index.upsert(vectors=vectors_to_upsert)
-        except Exception as e:
-            print(f"Error upserting vectors: {str(e)}")
+            yield
+        except BaseException as e:
+            self._finish(e)
+            raise
+        self._finish(None)
 
-    def query_vectors(self, query_vector, top_k=3):
-        if self.index is None:
-            return type('obj', (object,), {'matches': []})
+    def should_retry(self, error, attempt):
+        return (
+            attempt < self.max_retries
+            and not isinstance(error, UpstreamUnavailable)
+            and self.transient(error)
+            and self.breaker.available()
+        )
+
+    def _retry_delay(self, attempt):
+        # Full jitter keeps retries from many callers from arriving in waves
+        metrics.increment('upstream_retries_total', upstream=self.name)
+        return random.uniform(0, UPSTREAM_RETRY_BASE_SECONDS * 2 ** attempt)
+
+    async def backoff_async(self, attempt):
+        await asyncio.sleep(self._retry_delay(attempt))
+
+    async def _attempt_async(self, fn, *args, **kwargs):
+        async with self.admit_async():
+            return await fn(*args, **kwargs)
+
+    async def _hedged_async(self, fn, *args, **kwargs):
+        """Send a second request if the first is still pending after `hedge_after`; the first answer wins"""
+        tasks = {asyncio.ensure_future(self._attempt_async(fn, *args, **kwargs))}
         try:
-            results = self.index.query(
-                vector=query_vector,
-                top_k=top_k,
-                include_metadata=True
-            )
-            return results
-        except Exception as e:
-            print(f"Error querying vectors: {str(e)}")
-            return type('obj', (object,), {'matches': []})
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            # Hedging only uses spare capacity, so it cannot add to a backlog
+            if not done and self.breaker.available() and self.bulkhead.in_flight < self.bulkhead.max_in_flight:
+                metrics.increment('upstream_hedges_total', upstream=self.name)
+                tasks.add(asyncio.ensure_future(self._attempt_async(fn, *args, **kwargs)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def call_async(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                if self.hedge_after > 0:
+                    return await self._hedged_async(fn, *args, **kwargs)
+                return await self._attempt_async(fn, *args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+            await self.backoff_async(attempt)
+            attempt += 1
+
+    def stats(self):
+        return {
+            'circuit': self.breaker.state,
+            'in_flight': self.bulkhead.in_flight,
+            'queued': self.bulkhead.queued,
+        }
+
+def transient_gemini_error(error):
+    """Rate limiting, server-side errors and timeouts; request errors (400, 403, blocked prompts) are not retried"""
+    return isinstance(error, (
+        google_exceptions.TooManyRequests, google_exceptions.ServerError, google_exceptions.DeadlineExceeded,
+        TimeoutError, ConnectionError,
+    ))
+
+gemini_upstream = Upstream(
+    "gemini", GEMINI_RATE_PER_SECOND, GEMINI_MAX_IN_FLIGHT, GEMINI_MAX_QUEUE, transient=transient_gemini_error
+)
+translation_upstream = Upstream(
+    "translation", TRANSLATION_RATE_PER_SECOND, TRANSLATION_MAX_IN_FLIGHT, TRANSLATION_MAX_QUEUE,
+    hedge_after=TRANSLATION_HEDGE_AFTER_SECONDS
+)
 
 # Gemini Handler
+class GeminiResponseError(Exception):
+    """Gemini failed before the answer was complete (after retries, or after text was already streamed)"""
+
 class GeminiHandler:
-    def __init__(self):
-        self.model = genai.GenerativeModel('gemini-2.5-flash-preview-04-17')
-        self.chat_sessions = {}
+    def __init__(self, sessions=None, model=None, upstream=None):
+        if model is None:
+            genai.configure(api_key=GOOGLE_API_KEY)
+            model = genai.GenerativeModel('gemini-2.5-flash-preview-04-17')
+        self.model = model
+        self.sessions = sessions if sessions is not None else ChatSessionStore()
+        self.upstream = upstream if upstream is not None else gemini_upstream
+        self.request_options = {'timeout': GEMINI_TIMEOUT_SECONDS}
+
+    async def _history_async(self, session_id):
+        # The session store may be SQLite or Redis: keep its I/O off the event loop
+        return await asyncio.to_thread(self.sessions.history, session_id) if session_id else []
 
-    def get_response(self, prompt, session_id=None):
+    async def get_response_async(self, prompt, session_id=None, user_message=None):
+        """Answer text; raises GeminiResponseError on failure and UpstreamUnavailable when shed"""
         try:
-            if session_id and session_id in self.chat_sessions:
-                chat = self.chat_sessions[session_id]
-                response = chat.send_message(prompt)
-            else:
-                chat = self.model.start_chat(history=[])
-                response = chat.send_message(prompt)
-                if session_id:
-                    self.chat_sessions[session_id] = chat
+            history = await self._history_async(session_id)
+            with metrics.time('gemini_seconds', mode='complete'):
+                response = await self.upstream.call_async(
+                    lambda: self.model.start_chat(history=history).send_message_async(prompt, request_options=self.request_options)
+                )
+            if session_id:
+                await asyncio.to_thread(self.sessions.record_turn, session_id, user_message or prompt, response.text)
             return response.text
+        except UpstreamUnavailable:
+            raise
         except Exception as e:
-            return f"Error generating response: {str(e)}"
+            metrics.increment('gemini_errors_total')
+            raise GeminiResponseError(str(e)) from e
 
-def translate_text(text, target_lang):
-    """
-    Translates text to the target language using Google Translate.
-    This function ensures the translation works for all supported languages.
-    """
-    if target_lang == 'en' or not text.strip():
-        return text
-    
-    # If auto, try to detect the language
-    if target_lang == 'auto':
-        try:
-            target_lang = langdetect.detect(text)
-            if target_lang not in ['hi', 'ta', 'te', 'bn', 'mr', 'gu', 'kn', 'ml', 'pa', 'or', 'ur']:
-                target_lang = 'en'
-        except Exception:
-            target_lang = 'en'
-    
+    async def stream_response_async(self, prompt, session_id=None, user_message=None):
+        """Yield the response text piece by piece as Gemini generates it.
+
+        A failed attempt is retried only while nothing has been yielded yet; after that
+        GeminiResponseError is raised and the cut-off turn is not recorded.
+        """
+        start = time.perf_counter()
+        pieces = []
+        attempt = 0
+        history = await self._history_async(session_id)
+        while True:
+            try:
+                async with self.upstream.admit_async():
+                    response = await self.model.start_chat(history=history).send_message_async(
+                        prompt, stream=True, request_options=self.request_options
+                    )
+                    async for chunk in response:
+                        try:
+                            text = chunk.text
+                        except ValueError:
+                            # Chunks without text parts (e.g. safety metadata only)
+                            continue
+                        if text:
+                            if not pieces:
+                                metrics.observe('gemini_first_token_seconds', time.perf_counter() - start)
+                            pieces.append(text)
+                            yield text
+                break
+            except UpstreamUnavailable:
+                raise
+            except Exception as e:
+                if pieces or not self.upstream.should_retry(e, attempt):
+                    metrics.increment('gemini_errors_total')
+                    raise GeminiResponseError(str(e)) from e
+            await self.upstream.backoff_async(attempt)
+            attempt += 1
+        metrics.observe('gemini_seconds', time.perf_counter() - start, mode='stream')
+        if session_id:
+            await asyncio.to_thread(self.sessions.record_turn, session_id, user_message or prompt, "".join(pieces))
+
+# Language Identification
+# Indic Unicode blocks (128 code points each) that identify a language by script alone.
+# Devanagari is shared by Hindi and Marathi and is disambiguated below.
+SCRIPT_BLOCKS = {
+    0x0900 >> 7: 'hi',  # Devanagari
+    0x0980 >> 7: 'bn',  # Bengali
+    0x0A00 >> 7: 'pa',  # Gurmukhi
+    0x0A80 >> 7: 'gu',  # Gujarati
+    0x0B00 >> 7: 'or',  # Odia
+    0x0B80 >> 7: 'ta',  # Tamil
+    0x0C00 >> 7: 'te',  # Telugu
+    0x0C80 >> 7: 'kn',  # Kannada
+    0x0D00 >> 7: 'ml',  # Malayalam
+}
+# Danda and double danda: Devanagari code points that Bengali, Gurmukhi and Odia text use too
+SHARED_PUNCTUATION = {'\u0964', '\u0965'}
+# Arabic script (Urdu): Arabic, Arabic Supplement, Presentation Forms-A and -B. Exact ranges,
+# since the neighbouring code points are Syriac and the variation selectors.
+ARABIC_RANGES = ((0x0600, 0x06FF), (0x0750, 0x077F), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF))
+MARATHI_MARKERS = {'आहे', 'आहेत', 'नाही', 'काय', 'माझा', 'माझी', 'माझे', 'मला', 'तुम्ही', 'आणि', 'कसे', 'आहात', 'सांगा'}
+HINDI_MARKERS = {'है', 'हैं', 'क्या', 'मेरा', 'मेरी', 'मेरे', 'नहीं', 'और', 'में', 'कैसे', 'मुझे', 'बताइए', 'बताओ', 'का', 'की'}
+ROMANIZED_HINDI_MARKERS = {'hai', 'hain', 'kya', 'mera', 'meri', 'mere', 'nahi', 'nahin', 'kaise', 'kaisa', 'mujhe', 'batao', 'bataiye', 'theek', 'thik', 'kyun', 'kitna', 'aur'}
+LANGID_CACHE_SIZE = 4096
+
+# Make langdetect's sampling reproducible across runs
+langdetect.DetectorFactory.seed = 0
+
+def script_language(ch):
+    """Language identified by the character's script alone, or None"""
+    if ch in SHARED_PUNCTUATION:
+        return None
+    code_point = ord(ch)
+    language = SCRIPT_BLOCKS.get(code_point >> 7)
+    if language:
+        return language
+    if any(low <= code_point <= high for low, high in ARABIC_RANGES):
+        return 'ur'
+    return None
+
+def _statistical_language(text, candidates, default):
+    """langdetect restricted to the candidate languages, used only for ambiguous text"""
     try:
-        print(f"[Translation] Translating to {target_lang}")
-        url = "https://translate.googleapis.com/translate_a/single"
-        
-        # First try direct translation from detected language to target
-        params = {
+        for guess in langdetect.detect_langs(text):
+            if guess.lang in candidates:
+                return guess.lang
+    except Exception:
+        pass
+    return default
+
+@lru_cache(maxsize=LANGID_CACHE_SIZE)
+def identify_language(text):
+    """Identify the language of a query by Unicode script, falling back to a statistical model
+    only for Hindi vs Marathi and romanized text. Returns a supported language code."""
+    counts = {}
+    latin = 0
+    for ch in text:
+        code_point = ord(ch)
+        if code_point < 0x250:
+            if ch.isalpha():
+                latin += 1
+            continue
+        # Combining marks (vowel signs, harakat, emoji variation selectors) are not counted
+        if unicodedata.category(ch).startswith('M'):
+            continue
+        language = script_language(ch)
+        if language:
+            counts[language] = counts.get(language, 0) + 1
+    # Indic queries often carry English test names, so any real Indic script wins over Latin
+    if counts and max(counts.values()) >= 2:
+        language = max(counts, key=counts.get)
+        if language != 'hi':
+            return language
+        words = set(re.findall(r'[\u0900-\u097F]+', text))
+        marathi, hindi = len(words & MARATHI_MARKERS), len(words & HINDI_MARKERS)
+        if marathi != hindi:
+            return 'mr' if marathi > hindi else 'hi'
+        return _statistical_language(text, ('hi', 'mr'), 'hi')
+    if not latin:
+        return 'en'
+    words = set(re.findall(r'[a-z]+', text.lower()))
+    romanized = len(words & ROMANIZED_HINDI_MARKERS)
+    if romanized >= 2:
+        return 'hi'
+    if romanized == 1:
+        return _statistical_language(text, ('hi', 'mr', 'en'), 'en')
+    return 'en'
+
+# Translation
+# "google" (default) or "stub" for an offline backend that only tags text with the target language
+TRANSLATION_BACKEND = os.getenv("TRANSLATION_BACKEND", "google")
+# Long answers are split into segments of at most this many characters and translated concurrently
+TRANSLATION_SEGMENT_CHARS = int(os.getenv("TRANSLATION_SEGMENT_CHARS", "1500"))
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "5000"))
+TRANSLATION_CACHE_TTL_SECONDS = float(os.getenv("TRANSLATION_CACHE_TTL_SECONDS", "86400"))
+TRANSLATION_TIMEOUT_SECONDS = float(os.getenv("TRANSLATION_TIMEOUT_SECONDS", "10"))
+TRANSLATE_URL = "https://translate.googleapis.com/translate_a/single"
+TRANSLATION_LANGUAGES = ['hi', 'ta', 'te', 'bn', 'mr', 'gu', 'kn', 'ml', 'pa', 'or', 'ur']
+
+class TranslationError(Exception):
+    """The translation backend answered, but without a usable translation"""
+
+class GoogleTranslateBackend:
+    """Google Translate over pooled keep-alive httpx connections.
+
+    The text is sent as a POST form body, so URL length limits do not apply to it.
+    """
+    def __init__(self, timeout=TRANSLATION_TIMEOUT_SECONDS, pool_size=MAX_CONCURRENT_CHATS):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        # An AsyncClient's connections belong to the event loop that opened them: one client per loop
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _params(target_lang):
+        return {
             'client': 'gtx',
             'sl': 'auto',  # Let Google detect the source language
             'tl': target_lang,
             'dt': 't',
-            'q': text
         }
-        
-        response = requests.get(url, params=params, timeout=10)  # Add timeout
-        if response.status_code == 200:
-            result = response.json()
-            translated = ''.join([item[0] for item in result[0]])
-            print(f"[Translation] Successfully translated to {target_lang}")
-            return translated
+
+    @staticmethod
+    def _parse(status_code, payload_fn):
+        if status_code != 200:
+            raise TranslationError(f"HTTP {status_code}")
+        return ''.join([item[0] for item in payload_fn()[0]])
+
+    def _get_async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            )
+        return client
+
+    async def translate_async(self, text, target_lang):
+        response = await self._get_async_client().post(
+            TRANSLATE_URL, params=self._params(target_lang), data={'q': text}
+        )
+        return self._parse(response.status_code, response.json)
+
+class StubTranslationBackend:
+    """Offline backend for tests and benchmarks: tags the text with the target language"""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    async def translate_async(self, text, target_lang):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return f"[{target_lang}] {text}"
+
+def create_translation_backend():
+    if TRANSLATION_BACKEND == "stub":
+        return StubTranslationBackend()
+    return GoogleTranslateBackend()
+
+TRANSLATION_PIECE = re.compile(r'(?<=\n)|(?<=[.!?।]\s)')
+
+def split_translation_segments(text, max_chars=TRANSLATION_SEGMENT_CHARS):
+    """Split text on line/sentence boundaries into segments of at most max_chars.
+
+    Segments keep their separators, so joining them returns the original text.
+    """
+    if len(text) <= max_chars:
+        return [text]
+    pieces = []
+    for piece in TRANSLATION_PIECE.split(text):
+        if len(piece) <= max_chars:
+            pieces.append(piece)
         else:
-            print(f"[Translation] Error: {response.status_code}")
-            # Fallback to English first if direct translation failed
-            return text + f"\n\n[Translation unavailable for {target_lang}]"
+            pieces.extend(re.findall(r'\S+\s*', piece))
+    segments, current = [], ""
+    for piece in pieces:
+        if current and len(current) + len(piece) > max_chars:
+            segments.append(current)
+            current = ""
+        current += piece
+    if current:
+        segments.append(current)
+    return segments
+
+class TranslationClient:
+    """Segmenting, caching front end for a translation backend.
+
+    Long text is split into bounded segments that are translated concurrently and
+    reassembled in order; segments are cached by (text hash, language) with LRU + TTL.
+    """
+    def __init__(self, backend, max_segment_chars=TRANSLATION_SEGMENT_CHARS,
+                 cache_size=TRANSLATION_CACHE_SIZE, cache_ttl=TRANSLATION_CACHE_TTL_SECONDS, upstream=None):
+        self.backend = backend
+        self.upstream = upstream if upstream is not None else translation_upstream
+        self.max_segment_chars = max_segment_chars
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_get(self, key):
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                metrics.increment('cache_requests_total', cache='translation', result='hit', language=key[1])
+                return entry[0]
+            if entry is not None:
+                del self._cache[key]
+            self.misses += 1
+        metrics.increment('cache_requests_total', cache='translation', result='miss', language=key[1])
+        return None
+
+    def _cache_put(self, key, value):
+        with self._cache_lock:
+            self._cache[key] = (value, time.monotonic() + self.cache_ttl)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    @staticmethod
+    def _split_whitespace(segment):
+        # Backends trim surrounding whitespace, so line breaks are carried over untouched
+        core = segment.strip()
+        leading = segment[:len(segment) - len(segment.lstrip())]
+        trailing = segment[len(segment.rstrip()):] if core else ""
+        return leading, core, trailing
+
+    async def _translate_segment_async(self, segment, target_lang):
+        leading, core, trailing = self._split_whitespace(segment)
+        if not core:
+            return segment
+        key = (content_hash(core), target_lang)
+        translated = self._cache_get(key)
+        if translated is None:
+            with metrics.time('translation_seconds', language=target_lang):
+                translated = await self.upstream.call_async(self.backend.translate_async, core, target_lang)
+            self._cache_put(key, translated)
+        return leading + translated + trailing
+
+    async def translate_async(self, text, target_lang):
+        segments = split_translation_segments(text, self.max_segment_chars)
+        results = await asyncio.gather(*(self._translate_segment_async(segment, target_lang) for segment in segments))
+        return ''.join(results)
+
+    def stats(self):
+        with self._cache_lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+translation_client = TranslationClient(create_translation_backend())
+
+def _resolve_target_language(text, target_lang):
+    # If auto, try to detect the language
+    if target_lang != 'auto':
+        return target_lang
+    return identify_language(text)
+
+def translation_fallback_note(error, target_lang):
+    """Note appended to an answer shown untranslated because translation failed"""
+    if isinstance(error, UpstreamUnavailable):
+        return f"[Translation temporarily unavailable for {target_lang}; showing the English answer]"
+    if isinstance(error, TranslationError):
+        return f"[Translation unavailable for {target_lang}]"
+    return f"[Translation error: {str(error)}]"
+
+def _translation_failed(error, target_lang):
+    print(f"[Translation] {type(error).__name__}: {str(error)}")
+    metrics.increment('translation_errors_total', language=target_lang)
+    return translation_fallback_note(error, target_lang)
+
+async def translate_with_fallback_async(text, target_lang):
+    """Translate text to a resolved language: (translation, None), or (text, note) when translation fails"""
+    try:
+        print(f"[Translation] Translating to {target_lang}")
+        translated = await translation_client.translate_async(text, target_lang)
+        print(f"[Translation] Successfully translated to {target_lang}")
+        return translated, None
     except Exception as e:
-        print(f"[Translation] Exception: {str(e)}")
-        return text + f"\n\n[Translation error: {str(e)}]"
+        return text, _translation_failed(e, target_lang)
+
+async def translate_text_async(text, target_lang):
+    """Translate text to the target language ('auto' detects it); on failure the text is kept, with a note"""
+    if target_lang == 'en' or not text.strip():
+        return text
+    target_lang = _resolve_target_language(text, target_lang)
+    if target_lang == 'en':
+        return text
+    translated, note = await translate_with_fallback_async(text, target_lang)
+    return translated + f"\n\n{note}" if note else translated
+
+# Sentence ends (including the Devanagari danda) and line breaks close a streamed segment
+STREAM_SEGMENT_END = re.compile(r'[.!?।](?=\s)|\n')
+
+def split_complete_sentences(buffer):
+    """Split streamed text into (complete sentences, unfinished remainder)"""
+    end = None
+    for match in STREAM_SEGMENT_END.finditer(buffer):
+        end = match.end()
+    if end is None:
+        return "", buffer
+    return buffer[:end], buffer[end:]
+
+async def translate_segment_async(segment, target_lang):
+    """Translate one streamed segment: (text, fallback note or None)"""
+    # Keep whitespace-only segments (line breaks between sentences) as they are
+    if not segment.strip():
+        return segment, None
+    return await translate_with_fallback_async(segment, target_lang)
 
 # MultiLanguage Agent
 class MultiLanguageAgent:
@@ -269,25 +2695,13 @@ class MultiLanguageAgent:
         
     def detect_language(self, text):
         """Detect the language of the input text"""
-        try:
-            detected = langdetect.detect(text)
-            return detected if detected in self.language_prompts else 'en'
-        except:
-            return 'en'
+        detected = identify_language(text)
+        return detected if detected in self.language_prompts else 'en'
             
-    def get_response(self, query, context, language, session_id):
-        """Get response from Gemini and ensure it's in the correct language"""
-        # If language is auto, detect from query
-        if language == "auto":
-            language = self.detect_language(query)
-            print(f"[Language] Auto-detected language: {language}")
-        
+    def build_prompt(self, query, context):
         # Always use English for better Gemini comprehension,
         # then translate to target language
-        system_prompt = self.language_prompts['en']
-        
-        # Use a dynamic prompt that ensures the LLM knows we want the response translated
-        prompt = f"""
+        return f"""
 You are a medical report assistant. Provide clear, helpful, and accurate explanations of 
 the uploaded medical report in ENGLISH, using simple language understandable by patients.
 
@@ -299,16 +2713,180 @@ User query: {query}
 Please respond in English. Your response will be automatically translated to the user's language.
 Always remind users that this is not a substitute for professional medical advice.
 """
-        # Get the response from Gemini
-        response = self.gemini.get_response(prompt, session_id)
-        
-        # Always translate if language is not English and not auto
-        if language != 'en':
-            print(f"[Language] Translating response to {language}")
-            translated_response = translate_text(response, language)
-            return translated_response
-        
-        return response
+
+    async def get_response_async(self, query, context, language, session_id, outcome=None):
+        """Answer from Gemini, translated to the language when it is not English.
+
+        `outcome['complete']` is set to whether Gemini answered in full and the answer
+        was fully translated; only complete answers may be reused. `outcome['english']`
+        holds Gemini's answer before translation, as kept in the session history.
+        """
+        outcome = outcome if outcome is not None else {}
+        outcome['complete'] = False
+        if language == "auto":
+            language = self.detect_language(query)
+            print(f"[Language] Auto-detected language: {language}")
+        try:
+            response = await self.gemini.get_response_async(self.build_prompt(query, context), session_id, user_message=query)
+        except GeminiResponseError as e:
+            return await translate_text_async(f"Error generating response: {str(e)}", language)
+        outcome['english'] = response
+        if language == 'en' or not response.strip():
+            outcome['complete'] = True
+            return response
+        print(f"[Language] Translating response to {language}")
+        translated, note = await translate_with_fallback_async(response, language)
+        outcome['complete'] = note is None
+        return translated + f"\n\n{note}" if note else translated
+
+    async def stream_response_async(self, query, context, language, session_id, outcome=None):
+        """Stream the answer, translating each complete sentence as soon as it arrives.
+
+        Yields the accumulated (translated) text after every update. `outcome` is filled
+        as in get_response_async; a failure mid-stream keeps the text so far and ends
+        with the error.
+        """
+        outcome = outcome if outcome is not None else {}
+        outcome['complete'] = False
+        if language == "auto":
+            language = self.detect_language(query)
+            print(f"[Language] Auto-detected language: {language}")
+        start = time.perf_counter()
+        first_token = first_output = None
+        output = ""
+        pending = deque()
+        buffer = ""
+        # Sentences that could not be translated are shown in English, with one note at the end
+        notes = []
+
+        def append(result):
+            text, note = result
+            if note and not notes:
+                notes.append(note)
+            return output + text
+
+        error = None
+        english = []
+        try:
+            async for piece in self.gemini.stream_response_async(self.build_prompt(query, context), session_id, user_message=query):
+                english.append(piece)
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                if language == 'en':
+                    output += piece
+                else:
+                    buffer += piece
+                    complete, buffer = split_complete_sentences(buffer)
+                    if complete:
+                        pending.append(asyncio.create_task(translate_segment_async(complete, language)))
+                    # Emit translated sentences strictly in order
+                    while pending and pending[0].done():
+                        output = append(pending.popleft().result())
+                if output:
+                    first_output = first_output or time.perf_counter() - start
+                    yield output
+        except GeminiResponseError as e:
+            error = f"Error generating response: {str(e)}"
+        if buffer.strip():
+            pending.append(asyncio.create_task(translate_segment_async(buffer, language)))
+        while pending:
+            output = append(await pending.popleft())
+            first_output = first_output or time.perf_counter() - start
+            yield output
+        if notes:
+            output += "\n\n" + "\n".join(notes)
+            yield output
+        if error:
+            error = await translate_text_async(error, language)
+            output = f"{output}\n\n{error}" if output else error
+            yield output
+        outcome['complete'] = error is None and not notes
+        outcome['english'] = "".join(english)
+        total = time.perf_counter() - start
+        print(
+            f"[Latency] language={language} first_token={(first_token or total) * 1000:.0f}ms "
+            f"first_output={(first_output or total) * 1000:.0f}ms total={total * 1000:.0f}ms"
+        )
+
+# Answer Cache
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Minimum cosine similarity between query embeddings for a cached answer to be reused
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_KEYS = int(os.getenv("ANSWER_CACHE_MAX_KEYS", "500"))
+ANSWER_CACHE_MAX_PER_KEY = int(os.getenv("ANSWER_CACHE_MAX_PER_KEY", "50"))
+
+class SemanticAnswerCache:
+    """Answers keyed by (document hash, language), matched on query embedding similarity.
+
+    Each answer is kept with its English original, which is what session history records.
+
+    Keys are evicted least-recently-used first; within a key the oldest answers go first.
+    """
+    def __init__(self, enabled=ANSWER_CACHE_ENABLED, threshold=ANSWER_CACHE_THRESHOLD,
+                 max_keys=ANSWER_CACHE_MAX_KEYS, max_per_key=ANSWER_CACHE_MAX_PER_KEY):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_keys = max_keys
+        self.max_per_key = max_per_key
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, doc_id, language, query_vector):
+        """(answer, English answer) for a similar earlier question, or None"""
+        if not self.enabled:
+            return None
+        query = self._normalize(query_vector)
+        with self._lock:
+            entry = self._entries.get((doc_id, language))
+            if entry is not None:
+                scores = np.stack(entry['vectors']) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end((doc_id, language))
+                    self.hits += 1
+                    metrics.increment('cache_requests_total', cache='answer', result='hit', language=language)
+                    return entry['answers'][best]
+            self.misses += 1
+        metrics.increment('cache_requests_total', cache='answer', result='miss', language=language)
+        return None
+
+    def store(self, doc_id, language, query_vector, answer, english):
+        if not self.enabled:
+            return
+        with self._lock:
+            key = (doc_id, language)
+            entry = self._entries.setdefault(key, {'vectors': deque(), 'answers': deque()})
+            entry['vectors'].append(self._normalize(query_vector))
+            entry['answers'].append((answer, english))
+            if len(entry['answers']) > self.max_per_key:
+                entry['vectors'].popleft()
+                entry['answers'].popleft()
+                self.evictions += 1
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                _, evicted = self._entries.popitem(last=False)
+                self.evictions += len(evicted['answers'])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'keys': len(self._entries),
+                'answers': sum(len(entry['answers']) for entry in self._entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
 
 # AGNO multi-agent setup
 LANGUAGE_CODES = [
@@ -335,45 +2913,126 @@ AGENT_INSTRUCTIONS = {
     'ur': "آپ ایک میڈیکل رپورٹ اسسٹنٹ ہیں۔ صرف اردو میں جواب دیں۔"
 }
 
-language_agents = []
-for code in LANGUAGE_CODES:
-    agent = Agent(
-        name=f"{LANGUAGE_NAMES[code]} Agent",
-        role=f"Medical report assistant for {LANGUAGE_NAMES[code]}",
+def create_language_team():
+    """Build one agno agent per language plus the routing team"""
+    from agno.agent import Agent
+    from agno.models.google.gemini import Gemini
+    from agno.team.team import Team
+
+    language_agents = []
+    for code in LANGUAGE_CODES:
+        agent = Agent(
+            name=f"{LANGUAGE_NAMES[code]} Agent",
+            role=f"Medical report assistant for {LANGUAGE_NAMES[code]}",
+            model=Gemini(id="gemini-2.5-flash-preview-04-17"),
+            instructions=[AGENT_INSTRUCTIONS[code]],
+            add_datetime_to_instructions=True,
+        )
+        language_agents.append(agent)
+
+    multi_language_team = Team(
+        name="ChikitsaBhasha Multi-Language Team",
+        mode="route",
         model=Gemini(id="gemini-2.5-flash-preview-04-17"),
-        instructions=[AGENT_INSTRUCTIONS[code]],
-        add_datetime_to_instructions=True,
+        members=language_agents,
+        show_tool_calls=True,
+        markdown=True,
+        instructions=[
+            "You are a language router that directs questions to the appropriate language agent.",
+            "If the user asks in a language whose agent is not a team member, respond in English with: 'I can only answer in the following languages: English, Hindi, Tamil, Telugu, Bengali, Marathi, Gujarati, Kannada, Malayalam, Punjabi, Odia, Urdu. Please ask your question in one of these languages.'",
+            "Always check the language of the user's input before routing to an agent.",
+            "For unsupported languages, respond in English with the above message.",
+        ],
+        show_members_responses=True,
     )
-    language_agents.append(agent)
-
-multi_language_team = Team(
-    name="ChikitsaBhasha Multi-Language Team",
-    mode="route",
-    model=Gemini(id="gemini-2.5-flash-preview-04-17"),
-    members=language_agents,
-    show_tool_calls=True,
-    markdown=True,
-    instructions=[
-        "You are a language router that directs questions to the appropriate language agent.",
-        "If the user asks in a language whose agent is not a team member, respond in English with: 'I can only answer in the following languages: English, Hindi, Tamil, Telugu, Bengali, Marathi, Gujarati, Kannada, Malayalam, Punjabi, Odia, Urdu. Please ask your question in one of these languages.'",
-        "Always check the language of the user's input before routing to an agent.",
-        "For unsupported languages, respond in English with the above message.",
-    ],
-    show_members_responses=True,
-)
+    return multi_language_team
 
 def multi_agent_response(user_message):
-    return multi_language_team.run(user_message, stream=False).content
+    return services.language_team.run(user_message, stream=False).content
+
+# Application Services
+class AppServices:
+    """Application components, each constructed on first use and timed for the startup report"""
+    WARM_UP_ORDER = ('doc_processor', 'vector_store', 'gemini_handler', 'multi_agent')
+
+    def __init__(self):
+        self._factories = {
+            'doc_processor': DocumentProcessor,
+            'vector_store': create_vector_store,
+            'gemini_handler': lambda: GeminiHandler(chat_sessions),
+            'multi_agent': lambda: MultiLanguageAgent(self.gemini_handler),
+            'language_team': create_language_team,
+        }
+        self._components = {}
+        self._locks = {name: threading.Lock() for name in self._factories}
+        self.startup_times = {}
+
+    def get(self, name):
+        component = self._components.get(name)
+        if component is not None:
+            return component
+        with self._locks[name]:
+            if name not in self._components:
+                start = time.perf_counter()
+                self._components[name] = self._factories[name]()
+                self.startup_times[name] = time.perf_counter() - start
+                print(f"[Startup] {name} ready in {self.startup_times[name]:.2f}s")
+            return self._components[name]
+
+    async def get_async(self, name):
+        """Like get, but a component that still has to be built is built off the event loop"""
+        component = self._components.get(name)
+        if component is not None:
+            return component
+        return await asyncio.to_thread(self.get, name)
+
+    def override(self, **components):
+        """Install pre-built components (e.g. fakes for benchmarks) instead of building them"""
+        self._components.update(components)
+
+    @property
+    def doc_processor(self):
+        return self.get('doc_processor')
+
+    @property
+    def vector_store(self):
+        return self.get('vector_store')
+
+    @property
+    def gemini_handler(self):
+        return self.get('gemini_handler')
+
+    @property
+    def multi_agent(self):
+        return self.get('multi_agent')
+
+    @property
+    def language_team(self):
+        return self.get('language_team')
+
+    def warm_up(self, names=WARM_UP_ORDER):
+        """Build components in a background thread so the first request does not pay for them"""
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    print(f"[Startup] Warm-up of {name} failed: {str(e)}")
+            breakdown = ", ".join(f"{name}={seconds:.2f}s" for name, seconds in self.startup_times.items())
+            print(f"[Startup] Warm-up complete: {breakdown}")
+        thread = threading.Thread(target=run, name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+services = AppServices()
 
 # Gradio Interface State
-session_id = str(uuid.uuid4())
-doc_processor = DocumentProcessor()
-pinecone_handler = PineconeHandler()
-gemini_handler = GeminiHandler()
-multi_agent = MultiLanguageAgent(gemini_handler)
+# The processed report and conversation of each user session, keyed by Gradio session hash
+chat_sessions = create_chat_session_store()
+answer_cache = SemanticAnswerCache()
 
-# Store processed reports in memory for this session
-processed_docs = {}
+# Bounded concurrency for the async request path
+chat_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHATS)
 
 # Supported languages for chat
 LANGUAGES = [
@@ -394,52 +3053,264 @@ LANGUAGES = [
 # Store selected language in session
 selected_language = gr.State("auto")
 
-def process_pdf_ui(pdf_file):
-    if pdf_file is None:
-        return "No file uploaded.", "No medical reports processed yet."
-    try:
-        if not pdf_file.name.lower().endswith('.pdf'):
-            return "⚠️ Please upload a PDF file.", "No medical reports processed yet."
-        text = doc_processor.extract_text_from_pdf(pdf_file)
-        if not text or len(text.strip()) == 0:
-            return "⚠️ Could not extract any text from the PDF. It might be a scanned report or image-based PDF.", "No medical reports processed yet."
-        chunks = doc_processor.chunk_text(text)
-        if not chunks:
-            return "⚠️ Could not create text chunks from the report.", "No medical reports processed yet."
-        embeddings = doc_processor.create_embeddings(chunks)
-        
-        # Clear previous context for every new doc
-        processed_docs.clear()
-        
-        # Delete all previous vectors from Pinecone to ensure clean context
-        if pinecone_handler.index is not None:
-            try:
-                # Delete all existing vectors
-                pinecone_handler.index.delete(delete_all=True)
-                print("[Pinecone] Successfully deleted all previous vectors")
-            except Exception as e:
-                print(f"[Pinecone] Error when deleting previous vectors: {str(e)}")
-        
-        # Add new vectors for the current document
-        pinecone_handler.upsert_vectors(embeddings, chunks, pdf_file.name, doc_id=None)
-        processed_docs[pdf_file.name] = {
-            'chunks': len(chunks),
-            'text_length': len(text),
-            'processed_at': datetime.now().isoformat(),
+DEFAULT_SESSION_ID = "default"
+
+def get_session_id(request):
+    """Per-browser-session ID assigned by Gradio (shared default outside the UI)"""
+    return getattr(request, 'session_hash', None) or DEFAULT_SESSION_ID
+
+def register_document(session_id, file_name, doc_id, chunks, text_length=None):
+    chat_sessions.set_document(session_id, {
+        'name': file_name,
+        'doc_id': doc_id,
+        'chunks': chunks,
+        'text_length': text_length,
+        'processed_at': datetime.now().isoformat(),
+    })
+
+# Ingestion Jobs
+# Uploads waiting or running beyond this are turned away until the queue drains
+INGEST_MAX_PENDING_JOBS = int(os.getenv("INGEST_MAX_PENDING_JOBS", "20"))
+# Finished jobs are remembered this long so repeated uploads join them instead of re-running
+INGEST_JOB_TTL_SECONDS = float(os.getenv("INGEST_JOB_TTL_SECONDS", "3600"))
+INGEST_PROGRESS_INTERVAL_SECONDS = 0.5
+
+NO_REPORT_MESSAGE = "No medical reports processed yet."
+FAILED_REPORT_MESSAGE = "No medical reports processed successfully."
+
+class IngestionJob:
+    """One report moving through extraction, embedding and storage.
+
+    Stages: queued -> extracting -> storing -> done | failed. Every session that
+    uploads the same content is attached to the job and gets the document registered
+    once it is done.
+    """
+    def __init__(self, doc_id, file_name, file_bytes):
+        self.doc_id = doc_id
+        self.file_name = file_name
+        self.file_bytes = file_bytes
+        self.stage = 'queued'
+        self.counts = {'pages': 0, 'chunks': 0, 'embedded': 0, 'stored': 0}
+        self.result = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+        self.done = threading.Event()
+        self._sessions = set()
+        self._registration = None
+        self._lock = threading.Lock()
+
+    def advance(self, stage=None, **counts):
+        """Move to a new stage and/or add to the progress counters"""
+        with self._lock:
+            if stage is not None:
+                self.stage = stage
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def attach(self, session_id):
+        """Register the document for a session now if the job is done, otherwise when it finishes"""
+        with self._lock:
+            registration = self._registration
+            if self.result is None:
+                self._sessions.add(session_id)
+        if registration is not None:
+            register_document(session_id, **registration)
+
+    def finish(self, result, registration=None):
+        """Record the (status, documents) messages and register the document for attached sessions"""
+        with self._lock:
+            self.stage = 'done' if registration is not None else 'failed'
+            self.result = result
+            self._registration = registration
+            self.finished_at = time.time()
+            self.file_bytes = None
+            sessions = list(self._sessions)
+            self._sessions.clear()
+        if registration is not None:
+            for session_id in sessions:
+                register_document(session_id, **registration)
+        # Only signal completion once every waiting session can chat about the report
+        self.done.set()
+
+    def progress_message(self, queued_ahead=0):
+        with self._lock:
+            stage, counts = self.stage, dict(self.counts)
+        if stage == 'queued':
+            return f"⏳ Waiting to be processed ({queued_ahead} report(s) ahead)."
+        lines = [f"⏳ Processing {os.path.basename(self.file_name)}...", f"- {counts['pages']} pages extracted"]
+        if counts['chunks']:
+            lines.append(f"- {counts['embedded']} of {counts['chunks']} chunks embedded")
+        if stage == 'storing':
+            lines.append(f"- {counts['stored']} of {counts['chunks']} vectors stored")
+        return "\n".join(lines)
+
+class IngestionQueue:
+    """Runs uploads on a bounded worker pool, one job per report content hash.
+
+    Submitting a report that is already queued, running or done joins the existing job;
+    only failed jobs are started again.
+    """
+    def __init__(self, max_workers=MAX_CONCURRENT_UPLOADS, max_pending=INGEST_MAX_PENDING_JOBS, job_ttl=INGEST_JOB_TTL_SECONDS):
+        self.max_pending = max_pending
+        self.job_ttl = job_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.joined = 0
+        self.rejected = 0
+
+    def _prune(self, now):
+        expired = [doc_id for doc_id, job in self._jobs.items() if job.done.is_set() and now - job.finished_at > self.job_ttl]
+        for doc_id in expired:
+            del self._jobs[doc_id]
+
+    def submit(self, file_bytes, file_name, session_id):
+        """Return the job processing this report, or None if too many jobs are pending"""
+        doc_id = content_hash(file_bytes)
+        with self._lock:
+            self._prune(time.time())
+            job = self._jobs.get(doc_id)
+            if job is not None and job.stage != 'failed':
+                self.joined += 1
+                metrics.increment('ingest_jobs_total', outcome='joined')
+                print(f"[Ingest] Upload of {doc_id} joined the existing job ({job.stage})")
+            else:
+                pending = sum(1 for queued in self._jobs.values() if not queued.done.is_set())
+                if pending >= self.max_pending:
+                    self.rejected += 1
+                    metrics.increment('ingest_jobs_total', outcome='rejected')
+                    print(f"[Ingest] Rejected upload of {doc_id}: {pending} jobs pending")
+                    return None
+                job = IngestionJob(doc_id, file_name, file_bytes)
+                self._jobs[doc_id] = job
+                self.submitted += 1
+                metrics.increment('ingest_jobs_total', outcome='submitted')
+                self._executor.submit(self._run, job)
+                print(f"[Ingest] Queued job {doc_id} for {file_name}")
+        job.attach(session_id)
+        return job
+
+    def queued_ahead(self, job):
+        with self._lock:
+            return sum(1 for other in self._jobs.values() if other.stage == 'queued' and other.submitted_at < job.submitted_at)
+
+    def stats(self):
+        with self._lock:
+            stages = [job.stage for job in self._jobs.values()]
+        return {
+            'jobs': len(stages),
+            'queued': stages.count('queued'),
+            'running': sum(stage in ('extracting', 'storing') for stage in stages),
+            'submitted': self.submitted,
+            'joined': self.joined,
+            'rejected': self.rejected,
         }
+
+    def _run(self, job):
+        start = time.perf_counter()
+        try:
+            result, registration = self._ingest(job)
+        except Exception as e:
+            result, registration = (f"❌ Error processing PDF: {str(e)}", FAILED_REPORT_MESSAGE), None
+        job.finish(result, registration)
+        metrics.observe('ingest_job_seconds', time.perf_counter() - start, status=job.stage, size=document_size_label(job.counts['pages']))
+        print(f"[Ingest] Job {job.doc_id} {job.stage} in {time.perf_counter() - start:.2f}s: {self.stats()}")
+
+    @staticmethod
+    def _ingest(job):
+        """Process one report; returns ((status, documents) messages, register_document kwargs or None)"""
+        job.advance('extracting')
+        # An identical report is already indexed in its own namespace: reuse it
+        existing_vectors = services.vector_store.document_vector_count(job.doc_id)
+        if existing_vectors:
+            print(f"[VectorStore] Document {job.doc_id} already indexed with {existing_vectors} vectors")
+            registration = {'file_name': job.file_name, 'doc_id': job.doc_id, 'chunks': existing_vectors}
+            return (f"✅ Report already processed.\n- {existing_vectors} chunks available", ""), registration
+
+        pages, chunks, embeddings = services.doc_processor.process_document(job.file_bytes, job.doc_id, progress=job.advance)
+        text_length = sum(len(page) for page in pages)
+        if not any(page.strip() for page in pages):
+            return ("⚠️ Could not extract any text from the PDF. It might be a scanned report or image-based PDF.", NO_REPORT_MESSAGE), None
+        if not chunks:
+            return ("⚠️ Could not create text chunks from the report.", NO_REPORT_MESSAGE), None
+        print(f"[Cache] Extraction cache stats: {services.doc_processor.cache.stats()}")
+
+        store_document_indexes(services.doc_processor.cache, job.doc_id, pages, chunks)
+
+        # Add new vectors for the current document in its own namespace
+        job.advance('storing')
+        upsert = services.vector_store.upsert_vectors(embeddings, chunks, job.file_name, doc_id=job.doc_id, progress=job.advance)
+        if not upsert['upserted']:
+            return ("❌ Could not store the report in the vector database. Please try again.", FAILED_REPORT_MESSAGE), None
+        registration = {'file_name': job.file_name, 'doc_id': job.doc_id, 'chunks': len(chunks), 'text_length': text_length}
+        if upsert['failed']:
+            return (
+                f"⚠️ Partially processed document.\n- {text_length:,} characters extracted\n- {upsert['upserted']} of {len(chunks)} chunks stored ({upsert['failed']} failed)",
+                ""
+            ), registration
         return (
-            f"✅ Successfully processed document.\n- {len(text):,} characters extracted\n- {len(chunks)} chunks created", 
+            f"✅ Successfully processed document.\n- {text_length:,} characters extracted\n- {len(chunks)} chunks created",
             ""
-        )
+        ), registration
+
+ingestion_queue = IngestionQueue()
+
+def _check_upload(pdf_file):
+    """Return (status, documents) messages rejecting the upload, or None if it can be queued"""
+    if pdf_file is None:
+        return "No file uploaded.", NO_REPORT_MESSAGE
+    if not pdf_file.name.lower().endswith('.pdf'):
+        return "⚠️ Please upload a PDF file.", NO_REPORT_MESSAGE
+    return None
+
+async def process_pdf_ui(pdf_file, request: gr.Request = None):
+    """Queue the upload and stream the job's progress until it finishes"""
+    rejection = _check_upload(pdf_file)
+    if rejection is not None:
+        yield rejection
+        return
+    try:
+        file_bytes = await asyncio.to_thread(DocumentProcessor.read_file_bytes, pdf_file)
     except Exception as e:
-        error_message = str(e)
-        return f"❌ Error processing PDF: {error_message}", "No medical reports processed successfully."
-
-def predict(message, history, chat_language):
-    """Process the user's message and generate a response"""
-    # Check if any document has been processed
-    if not processed_docs:
-        return "Please upload and process a medical report first."
+        yield f"❌ Error processing PDF: {str(e)}", FAILED_REPORT_MESSAGE
+        return
+    job = ingestion_queue.submit(file_bytes, pdf_file.name, get_session_id(request))
+    if job is None:
+        yield "⚠️ Too many reports are being processed right now. Please try again in a minute.", NO_REPORT_MESSAGE
+        return
+    last_message = None
+    while not job.done.is_set():
+        message = job.progress_message(ingestion_queue.queued_ahead(job))
+        if message != last_message:
+            yield message, ""
+            last_message = message
+        await asyncio.sleep(INGEST_PROGRESS_INTERVAL_SECONDS)
+    yield job.result
+
+GEMINI_UNAVAILABLE_MESSAGE = (
+    "The assistant is handling too many requests right now and could not answer this question. "
+    "Please try again in a minute."
+)
+
+async def unavailable_answer(lab_rows, language, reason):
+    """Answer when Gemini refuses the call: the matching lab values if there are any, else a retry notice"""
+    source = 'lab_table' if lab_rows else 'notice'
+    print(f"[Resilience] Gemini unavailable ({reason}), answering with {source}")
+    metrics.increment('chat_fallbacks_total', reason=reason, source=source)
+    answer = lab_lookup_answer(lab_rows) if lab_rows else GEMINI_UNAVAILABLE_MESSAGE
+    return await translate_text_async(answer, language)
+
+async def predict(message, history, chat_language, session_id=DEFAULT_SESSION_ID):
+    """Process the user's message and yield the response as it is generated"""
+    # Check if this session has processed a document (session and cache reads may hit SQLite or Redis)
+    doc = await asyncio.to_thread(chat_sessions.document, session_id)
+    if doc is None:
+        yield "Please upload and process a medical report first."
+        return
+    # Models are built on first use; a chat during warm-up must not block the loop for every session
+    doc_processor = await services.get_async('doc_processor')
+    multi_agent = await services.get_async('multi_agent')
     
     # Always use the language selected in the radio button, unless it's set to auto
     if chat_language and chat_language != "auto":
@@ -449,22 +3320,8 @@ def predict(message, history, chat_language):
         language = multi_agent.detect_language(message)
         print(f"[Language] Auto-detected language: {language}")
     
-    # Get the latest document
-    if processed_docs:
-        last_doc = list(processed_docs.keys())[-1]
-        print(f"[Document] Using document: {last_doc}")
-    
-    # Embed the query and search for relevant context
-    query_embedding = doc_processor.create_embeddings([message])[0]
-    results = pinecone_handler.query_vectors(query_embedding)
-    context = ""
-    if results.matches:
-        context = "\n".join([match.metadata['text'] for match in results.matches])
-        print(f"[Context] Found {len(results.matches)} relevant chunks")
-    
-    # Generate response in the selected language
-    print(f"[Response] Generating response in {language}")
-    response = multi_agent.get_response(message, context, language, session_id)
+    doc_id = doc['doc_id']
+    print(f"[Document] Using document: {doc['name']}")
     
     # Add language indicator to the response for UI display
     lang_names = {
@@ -473,13 +3330,88 @@ def predict(message, history, chat_language):
         'ml': 'മലയാളം', 'pa': 'ਪੰਜਾਬੀ', 'or': 'ଓଡ଼ିଆ', 'ur': 'اردو',
         'auto': 'Auto-detected'
     }
-    
     lang_display = lang_names.get(language, language)
-    response_with_lang = f"{response}\n\n*Language: {lang_display}*"
+    start = time.perf_counter()
+    
+    # Direct questions about a test's value are answered from the parsed lab table
+    labs = await asyncio.to_thread(lab_table, doc_id)
+    lab_rows = labs.find(message) if labs is not None else []
+    if LAB_FAST_PATH_ENABLED and is_lab_value_lookup(message, lab_rows):
+        answer = lab_lookup_answer(lab_rows)
+        await asyncio.to_thread(chat_sessions.record_turn, session_id, message, answer)
+        answer = await translate_text_async(answer, language)
+        print(f"[Labs] Answered from the lab table ({len(lab_rows)} results)")
+        metrics.observe('chat_response_seconds', time.perf_counter() - start, language=language, source='lab_table')
+        yield f"{answer}\n\n*Language: {lang_display}*"
+        return
+    
+    # Fail fast while Gemini's circuit is open or its queue is full, before any retrieval work
+    if not multi_agent.gemini.upstream.available():
+        answer = await unavailable_answer(lab_rows, language, 'shed')
+        metrics.observe('chat_response_seconds', time.perf_counter() - start, language=language, source='fallback')
+        yield f"{answer}\n\n*Language: {lang_display}*"
+        return
+    
+    async with chat_semaphore:
+        # Embed the query and search for relevant context within the document's namespace
+        with metrics.time('query_embedding_seconds'):
+            query_embedding = (await asyncio.wrap_future(doc_processor.embedding_service.submit([message])))[0]
+        
+        # Near-identical question about the same report in the same language: reuse the answer
+        cached = answer_cache.lookup(doc_id, language, query_embedding)
+        if cached is not None:
+            cached, english = cached
+            print(f"[AnswerCache] Hit ({answer_cache.stats()['hit_rate']:.0%} hit rate)")
+            # History holds English answers, as Gemini and the lab table record them
+            await asyncio.to_thread(chat_sessions.record_turn, session_id, message, english)
+            metrics.observe('chat_response_seconds', time.perf_counter() - start, language=language, source='cache')
+            yield f"{cached}\n\n*Language: {lang_display}*"
+            return
+        
+        # Dense and keyword (BM25) results fused into a token-bounded context;
+        # matching lab rows go first in compact form and take half the budget's place
+        context_budget = CONTEXT_MAX_TOKENS // 2 if lab_rows else CONTEXT_MAX_TOKENS
+        context, retrieval = await asyncio.to_thread(retrieve_context, message, query_embedding, doc_id, max_tokens=context_budget)
+        if context:
+            print(f"[Context] Using {retrieval['chunks']} chunks (~{retrieval['tokens']} tokens) from "
+                  f"{retrieval['dense']} dense and {retrieval['keyword']} keyword candidates")
+        if lab_rows:
+            rows = "\n".join(format_lab_result(result) for result in lab_rows)
+            context = f"Lab results:\n{rows}\n\n{context}" if context else f"Lab results:\n{rows}"
+            print(f"[Labs] Added {len(lab_rows)} lab results to the context")
+        
+        # Generate response in the selected language
+        print(f"[Response] Generating response in {language}")
+        first_output = None
+        outcome = {}
+        try:
+            if STREAM_RESPONSES:
+                response = ""
+                async for response in multi_agent.stream_response_async(message, context, language, session_id, outcome):
+                    if not response:
+                        continue
+                    if first_output is None:
+                        first_output = time.perf_counter() - start
+                        metrics.observe('chat_first_output_seconds', first_output, language=language)
+                    yield response
+            else:
+                response = await multi_agent.get_response_async(message, context, language, session_id, outcome)
+        except UpstreamUnavailable as e:
+            answer = await unavailable_answer(lab_rows, language, e.reason)
+            metrics.observe('chat_response_seconds', time.perf_counter() - start, language=language, source='fallback')
+            yield f"{answer}\n\n*Language: {lang_display}*"
+            return
+        # Never reuse failed, cut-off or untranslated answers: they would keep being served after a recovery
+        if outcome.get('complete') and response.strip():
+            answer_cache.store(doc_id, language, query_embedding, response, outcome['english'])
+    metrics.observe('chat_response_seconds', time.perf_counter() - start, language=language, source='rag')
     
-    return response_with_lang
+    print(f"[Sessions] {await asyncio.to_thread(chat_sessions.stats)}")
+    yield f"{response}\n\n*Language: {lang_display}*"
 
-with gr.Blocks(theme=gr.themes.Soft(primary_hue="blue", secondary_hue="indigo"), fill_height=True, css="""
+def create_app():
+    """Build the Gradio UI; components behind it are created lazily by `services`"""
+    with gr.Blocks(theme=gr.themes.Soft(primary_hue="blue", secondary_hue="indigo"), fill_height=True, css="""
 body { background: linear-gradient(120deg, #f8fafc 0%, #e0e7ef 100%); }
 .gradio-container { background: transparent !important; }
 #main-card { box-shadow: 0 8px 32px 0 rgba(60,60,60,0.12); border-radius: 22px; background: var(--gr-secondary-100, #fff); padding: 36px 32px 32px 32px; margin-top: 32px; margin-bottom: 32px; border: 1.5px solid #e0e7ef; }
@@ -497,7 +3429,7 @@ body { background: linear-gradient(120deg, #f8fafc 0%, #e0e7ef 100%); }
 @media (max-width: 900px) { #main-card { padding: 16px 2vw; } }
 @media (max-width: 700px) { #main-card { flex-direction: column !important; } }
 """) as demo:
-    gr.Markdown("""
+        gr.Markdown("""
 <div id='brand-title'>
   <span style='color:#2563eb;'>Chikitsa</span><span style='color:#6366f1;'>Bhasha</span>
 </div>
@@ -505,80 +3437,98 @@ body { background: linear-gradient(120deg, #f8fafc 0%, #e0e7ef 100%); }
   Medical Insights in Your Language<br>
 </div>
 """)
-    with gr.Row(elem_id="main-card"):
-        with gr.Column(scale=1, elem_id="left-panel"):
-            gr.Markdown("<span style='font-size:1.18em;font-weight:700;color:#2563eb;'>Language & Report Upload</span>")
-            lang_buttons = gr.Radio(
-                choices=[("Auto-detect / स्वतः-चयन", "auto")] + [(name, code) for name, code in LANGUAGES],
-                value="auto",
-                label="Chat Language",
-                interactive=True
-            )
-            lang_status = gr.Markdown("**Current language**: Auto-detect", elem_id="lang-status")
+        with gr.Row(elem_id="main-card"):
+            with gr.Column(scale=1, elem_id="left-panel"):
+                gr.Markdown("<span style='font-size:1.18em;font-weight:700;color:#2563eb;'>Language & Report Upload</span>")
+                lang_buttons = gr.Radio(
+                    choices=[("Auto-detect / स्वतः-चयन", "auto")] + [(name, code) for name, code in LANGUAGES],
+                    value="auto",
+                    label="Chat Language",
+                    interactive=True
+                )
+                lang_status = gr.Markdown("**Current language**: Auto-detect", elem_id="lang-status")
             
-            # Display change in selected language
-            def update_lang_status(lang_value):
-                lang_names = {
-                    'en': 'English', 'hi': 'हिन्दी', 'ta': 'தமிழ்', 'te': 'తెలుగు', 
-                    'bn': 'বাংলা', 'mr': 'मराठी', 'gu': 'ગુજરાતી', 'kn': 'ಕನ್ನಡ',
-                    'ml': 'മലയാളം', 'pa': 'ਪੰਜਾਬੀ', 'or': 'ଓଡ଼ିଆ', 'ur': 'اردو',
-                    'auto': 'Auto-detect'
-                }
-                lang_name = lang_names.get(lang_value, lang_value)
-                return f"**Current language**: {lang_name}"
+                # Display change in selected language
+                def update_lang_status(lang_value):
+                    lang_names = {
+                        'en': 'English', 'hi': 'हिन्दी', 'ta': 'தமிழ்', 'te': 'తెలుగు', 
+                        'bn': 'বাংলা', 'mr': 'मराठी', 'gu': 'ગુજરાતી', 'kn': 'ಕನ್ನಡ',
+                        'ml': 'മലയാളം', 'pa': 'ਪੰਜਾਬੀ', 'or': 'ଓଡ଼ିଆ', 'ur': 'اردو',
+                        'auto': 'Auto-detect'
+                    }
+                    lang_name = lang_names.get(lang_value, lang_value)
+                    return f"**Current language**: {lang_name}"
                 
-            # Update language status when language selection changes
-            lang_buttons.change(
-                update_lang_status,
-                inputs=lang_buttons,
-                outputs=lang_status
-            )
+                # Update language status when language selection changes
+                lang_buttons.change(
+                    update_lang_status,
+                    inputs=lang_buttons,
+                    outputs=lang_status
+                )
             
-            gr.Markdown("<span style='font-size:1.12em;font-weight:600;color:#6366f1;'>Upload your medical report (PDF)</span>")
-            pdf_input = gr.File(label="Upload Medical Report (PDF)", file_types=[".pdf"])
-            process_btn = gr.Button("Process Medical Report", variant="primary")
-            process_output = gr.Markdown("", elem_id="process-status")
-            docs_output = gr.Markdown("", elem_id="docs-status")
-            pdf_input.change(
-                process_pdf_ui,
-                inputs=pdf_input,
-                outputs=[process_output, docs_output],
-                queue=False
-            )
-            process_btn.click(
-                process_pdf_ui,
-                inputs=pdf_input,
-                outputs=[process_output, docs_output],
-                queue=False
-            )
-        with gr.Column(scale=2, elem_id="right-panel"):
-            # Redefine chat interface to always use the latest value of the language radio button
-            def chat_predict(message, history):
-                # Always get the latest value of the language radio button
-                try:
-                    lang = lang_buttons.value
-                except Exception:
-                    lang = "auto"
-                return predict(message, history, lang)
-            chat = gr.ChatInterface(
-                fn=chat_predict,
-                chatbot=gr.Chatbot(
-                    label="Medical Report Chat",
-                    type="messages", 
-                    show_copy_button=True,
-                    render_markdown=True,
-                ),
-                textbox=gr.Textbox(
-                    placeholder="Ask about your medical report in your regional language...",
-                    show_label=False,
-                    lines=1,
-                    interactive=True,
-                    submit_btn="Send"
+                gr.Markdown("<span style='font-size:1.12em;font-weight:600;color:#6366f1;'>Upload your medical report (PDF)</span>")
+                pdf_input = gr.File(label="Upload Medical Report (PDF)", file_types=[".pdf"])
+                process_btn = gr.Button("Process Medical Report", variant="primary")
+                process_output = gr.Markdown("", elem_id="process-status")
+                docs_output = gr.Markdown("", elem_id="docs-status")
+                pdf_input.change(
+                    process_pdf_ui,
+                    inputs=pdf_input,
+                    outputs=[process_output, docs_output]
                 )
-            )
-    gr.Markdown("---")
-    gr.Markdown("""
+                process_btn.click(
+                    process_pdf_ui,
+                    inputs=pdf_input,
+                    outputs=[process_output, docs_output]
+                )
+            with gr.Column(scale=2, elem_id="right-panel"):
+                # Redefine chat interface to always use the latest value of the language radio button
+                async def chat_predict(message, history, request: gr.Request):
+                    # Always get the latest value of the language radio button
+                    try:
+                        lang = lang_buttons.value
+                    except Exception:
+                        lang = "auto"
+                    async for partial in predict(message, history, lang, get_session_id(request)):
+                        yield partial
+                chat = gr.ChatInterface(
+                    fn=chat_predict,
+                    chatbot=gr.Chatbot(
+                        label="Medical Report Chat",
+                        type="messages", 
+                        show_copy_button=True,
+                        render_markdown=True,
+                    ),
+                    textbox=gr.Textbox(
+                        placeholder="Ask about your medical report in your regional language...",
+                        show_label=False,
+                        lines=1,
+                        interactive=True,
+                        submit_btn="Send"
+                    )
+                )
+        gr.Markdown("---")
+        gr.Markdown("""
 <div id='footer' style='text-align:left;'>Minimal RAG Chatbot for Medical Reports in Indian Regional Languages. <span style='float:right'>Built with ❤️ by Punith Kumar</span></div>
 """)
+    demo.queue(default_concurrency_limit=MAX_CONCURRENT_CHATS)
+    return demo
+
+def main():
+    validate_environment()
+    print(f"[Startup] Module set-up took {_app_imported - _import_started:.2f}s")
+    start = time.perf_counter()
+    demo = create_app()
+    print(f"[Startup] UI built in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    demo.launch(prevent_thread_lock=True)
+    print(f"[Startup] Server accepting connections after {time.perf_counter() - start:.2f}s")
+    start_metrics_server()
+    # Heavy components load in the background once the server is reachable
+    services.warm_up()
+    demo.block_thread()
+
+_app_imported = time.perf_counter()
 
-demo.launch()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,727 @@
+"""
+Benchmarks for the ChikitsaBhasha ingestion and chat pipeline.
+
+Usage:
+    python benchmark.py chunker [report.pdf ...]
+    python benchmark.py langid [--repeat N]
+    python benchmark.py pipeline [--users 1 4 16] [--gemini-ms 800] [--latency lognormal]
+    python benchmark.py embedding [--backends torch onnx onnx-int8] [--threads N]
+    python benchmark.py workers [--workers 1 2 4] [--state sqlite|redis|memory]
+
+Without PDF arguments a synthetic lab report is used, so the benchmark runs offline
+once the embedding model is available locally. The pipeline benchmark replaces
+Gemini, Pinecone and Google Translate with local fakes of configurable latency.
+"""
+import argparse
+import asyncio
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+from google.api_core.exceptions import ServiceUnavailable
+
+import app
+from app import DocumentProcessor, identify_language
+
+# Analytes used to build synthetic lab reports: (name, unit, low, high)
+LAB_TESTS = [
+    ("Hemoglobin", "g/dL", 13.0, 17.0),
+    ("Total Leukocyte Count", "10^3/uL", 4.0, 11.0),
+    ("Platelet Count", "10^3/uL", 150, 410),
+    ("Red Blood Cell Count", "10^6/uL", 4.5, 5.5),
+    ("Hematocrit", "%", 40, 50),
+    ("Mean Corpuscular Volume", "fL", 83, 101),
+    ("Fasting Blood Glucose", "mg/dL", 70, 100),
+    ("HbA1c", "%", 4.0, 5.6),
+    ("Serum Creatinine", "mg/dL", 0.7, 1.3),
+    ("Blood Urea Nitrogen", "mg/dL", 7, 20),
+    ("Uric Acid", "mg/dL", 3.5, 7.2),
+    ("Total Cholesterol", "mg/dL", 125, 200),
+    ("HDL Cholesterol", "mg/dL", 40, 60),
+    ("LDL Cholesterol", "mg/dL", 0, 100),
+    ("Triglycerides", "mg/dL", 0, 150),
+    ("TSH", "uIU/mL", 0.4, 4.0),
+    ("Free T4", "ng/dL", 0.8, 1.8),
+    ("Vitamin D 25-Hydroxy", "ng/mL", 30, 100),
+    ("Vitamin B12", "pg/mL", 200, 900),
+    ("Serum Sodium", "mmol/L", 135, 145),
+    ("Serum Potassium", "mmol/L", 3.5, 5.1),
+    ("SGPT ALT", "U/L", 7, 56),
+    ("SGOT AST", "U/L", 10, 40),
+    ("Alkaline Phosphatase", "U/L", 44, 147),
+    ("Total Bilirubin", "mg/dL", 0.1, 1.2),
+    ("Serum Albumin", "g/dL", 3.4, 5.4),
+    ("C-Reactive Protein", "mg/L", 0, 5),
+    ("Serum Iron", "ug/dL", 60, 170),
+    ("Ferritin", "ng/mL", 24, 336),
+    ("ESR", "mm/hr", 0, 20),
+]
+
+NARRATIVE = [
+    "The sample was collected in the morning after an overnight fast of ten hours.",
+    "Results should be correlated clinically with the patient's history and medication.",
+    "Values outside the biological reference interval are highlighted for the physician.",
+    "Repeat testing is advised if the results do not match the clinical picture.",
+    "This report has been electronically verified by the consultant pathologist.",
+]
+
+
+def synthetic_lab_report(num_pages=6, seed=7):
+    """Build page texts that look like a multi-department lab report"""
+    rng = random.Random(seed)
+    pages = []
+    tests = list(LAB_TESTS)
+    per_page = max(1, len(tests) // num_pages)
+    for page_number in range(num_pages):
+        lines = [
+            "City Diagnostics Laboratory, Bengaluru",
+            f"Patient: Test Patient    Age/Sex: 52/M    Page {page_number + 1} of {num_pages}",
+            "Test Name    Result    Unit    Biological Reference Interval",
+        ]
+        for name, unit, low, high in tests[page_number * per_page:(page_number + 1) * per_page]:
+            value = round(rng.uniform(low * 0.7, high * 1.3 if high else 1.0), 1)
+            lines.append(f"{name}    {value}    {unit}    {low} - {high}")
+        lines.extend(rng.sample(NARRATIVE, 3))
+        pages.append("\n".join(lines))
+    return pages
+
+
+def legacy_chunk_text(text, chunk_size=1000, overlap=200):
+    """The original fixed-size character chunker, kept as the comparison baseline"""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        chunks.append(text[start:end])
+        start = end - overlap
+    return chunks
+
+
+def lab_line_queries(pages):
+    """Turn each lab result row into (query, expected_line) pairs for retrieval scoring"""
+    queries = []
+    for page in pages:
+        for line in page.splitlines():
+            match = re.match(r"\s*([A-Za-z][A-Za-z0-9 ()\-]+?)\s{2,}([\d.]+)\s", line)
+            if match:
+                queries.append((f"What is my {match.group(1).strip()} level?", line.strip()))
+    return queries
+
+
+def retrieval_hit_rate(model, chunks, embeddings, queries, top_k=3):
+    """Fraction of queries whose full result row appears intact in a top-k chunk"""
+    if not queries or not chunks:
+        return 0.0
+    query_vectors = np.asarray(model.encode([query for query, _ in queries]), dtype=np.float32)
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    query_vectors = query_vectors / np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    scores = query_vectors @ matrix.T
+    normalized = [" ".join(chunk.split()) for chunk in chunks]
+    hits = 0
+    for row, (_, expected) in zip(scores, queries):
+        expected = " ".join(expected.split())
+        top = np.argsort(-row)[:top_k]
+        hits += any(expected in normalized[i] for i in top)
+    return hits / len(queries)
+
+
+def bench_chunker(args):
+    processor = DocumentProcessor(ocr_workers=args.ocr_workers)
+    model = processor.model
+    if args.pdfs:
+        documents = []
+        for path in args.pdfs:
+            with open(path, 'rb') as f:
+                documents.append((path, processor.extract_pages(f.read())))
+    else:
+        documents = [("synthetic", synthetic_lab_report(args.pages))]
+
+    chunkers = {
+        'legacy-chars': lambda pages: legacy_chunk_text("".join(pages)),
+        'streaming-tokens': lambda pages: list(processor.iter_chunks(iter(pages))),
+    }
+    print(f"{'document':<24}{'chunker':<20}{'chunks':>8}{'max tok':>9}{'chunk ms':>10}{'embed ms':>10}{'hit@3':>8}")
+    for name, pages in documents:
+        queries = lab_line_queries(pages)
+        for label, chunk_fn in chunkers.items():
+            start = time.perf_counter()
+            chunks = chunk_fn(pages)
+            chunk_ms = (time.perf_counter() - start) * 1000
+            # Encode directly so the embedding cache does not flatter the second chunker
+            start = time.perf_counter()
+            embeddings = model.encode(chunks, batch_size=64)
+            embed_ms = (time.perf_counter() - start) * 1000
+            max_tokens = max((processor.chunker.count_tokens(chunk) for chunk in chunks), default=0)
+            hit_rate = retrieval_hit_rate(model, chunks, embeddings, queries)
+            print(f"{name[-23:]:<24}{label:<20}{len(chunks):>8}{max_tokens:>9}{chunk_ms:>10.1f}{embed_ms:>10.1f}{hit_rate:>8.2f}")
+
+
+# Typical chat queries with their expected language
+LANGID_SAMPLES = [
+    ("Is my hemoglobin normal?", "en"),
+    ("What does high creatinine mean?", "en"),
+    ("Explain my thyroid report in simple words", "en"),
+    ("मेरा hemoglobin normal है क्या?", "hi"),
+    ("मेरी रिपोर्ट में शुगर कितनी है?", "hi"),
+    ("क्या मुझे डॉक्टर से मिलना चाहिए?", "hi"),
+    ("माझे hemoglobin ठीक आहे का?", "mr"),
+    ("माझ्या रिपोर्टमध्ये साखर किती आहे?", "mr"),
+    ("मला डॉक्टरकडे जायला हवे का?", "mr"),
+    ("என் ஹீமோகுளோபின் சரியா?", "ta"),
+    ("என் அறிக்கையில் சர்க்கரை எவ்வளவு?", "ta"),
+    ("నా హిమోగ్లోబిన్ సాధారణంగా ఉందా?", "te"),
+    ("నా రిపోర్ట్‌లో షుగర్ ఎంత?", "te"),
+    ("আমার হিমোগ্লোবিন কি স্বাভাবিক?", "bn"),
+    ("আমার রিপোর্টে সুগার কত?", "bn"),
+    ("શું મારું હિમોગ્લોબિન સામાન્ય છે?", "gu"),
+    ("ನನ್ನ ಹಿಮೋಗ್ಲೋಬಿನ್ ಸಾಮಾನ್ಯವಾಗಿದೆಯೇ?", "kn"),
+    ("എന്റെ ഹീമോഗ്ലോബിൻ സാധാരണമാണോ?", "ml"),
+    ("ਕੀ ਮੇਰਾ ਹੀਮੋਗਲੋਬਿਨ ਠੀਕ ਹੈ?", "pa"),
+    ("ମୋ ହିମୋଗ୍ଲୋବିନ୍ ଠିକ୍ ଅଛି କି?", "or"),
+    ("کیا میرا ہیموگلوبن نارمل ہے؟", "ur"),
+    ("mera sugar level theek hai kya", "hi"),
+    ("TSH 5.2", "en"),
+]
+
+SUPPORTED_LANGUAGES = {'en', 'hi', 'ta', 'te', 'bn', 'mr', 'gu', 'kn', 'ml', 'pa', 'or', 'ur'}
+
+
+def langdetect_baseline(text):
+    """The previous detector: raw langdetect, unsupported results mapped to English"""
+    import langdetect
+    try:
+        detected = langdetect.detect(text)
+    except Exception:
+        return 'en'
+    return detected if detected in SUPPORTED_LANGUAGES else 'en'
+
+
+def bench_langid(args):
+    detectors = {
+        'langdetect': langdetect_baseline,
+        'script-langid': identify_language.__wrapped__,
+        'script-langid cached': identify_language,
+    }
+    print(f"{'detector':<22}{'cold ms':>10}{'us/query':>12}{'accuracy':>10}")
+    for label, detect in detectors.items():
+        start = time.perf_counter()
+        detect(LANGID_SAMPLES[0][0])
+        cold_ms = (time.perf_counter() - start) * 1000
+        correct = sum(detect(text) == expected for text, expected in LANGID_SAMPLES)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for text, _ in LANGID_SAMPLES:
+                detect(text)
+        per_query_us = (time.perf_counter() - start) / (args.repeat * len(LANGID_SAMPLES)) * 1e6
+        print(f"{label:<22}{cold_ms:>10.1f}{per_query_us:>12.1f}{correct / len(LANGID_SAMPLES):>10.0%}")
+    for text, expected in LANGID_SAMPLES:
+        baseline, script = langdetect_baseline(text), identify_language(text)
+        if baseline != expected or script != expected:
+            print(f"  {text!r}: expected={expected} langdetect={baseline} script={script}")
+
+
+# Offline pipeline benchmark
+class LatencyModel:
+    """Simulated service latency: fixed, or log-normally sampled around the mean"""
+    SIGMA = 0.5
+
+    def __init__(self, mean_ms, distribution="fixed", seed=None):
+        self.mean = mean_ms / 1000.0
+        self.distribution = distribution
+        self.rng = random.Random(seed)
+
+    def sample(self):
+        if self.mean <= 0:
+            return 0.0
+        if self.distribution == "fixed":
+            return self.mean
+        return self.rng.lognormvariate(math.log(self.mean) - self.SIGMA ** 2 / 2, self.SIGMA)
+
+
+class FakeGeminiChat:
+    def __init__(self, model):
+        self.model = model
+
+    def _answer(self):
+        """Simulated latency, and the injected failure if this call draws one"""
+        seconds = self.model.latency.sample()
+        failed = self.model.rng.random() < self.model.error_rate
+        return seconds, failed
+
+    async def send_message_async(self, prompt, stream=False, request_options=None):
+        seconds, failed = self._answer()
+        if not stream:
+            await asyncio.sleep(seconds)
+            if failed:
+                raise ServiceUnavailable("simulated Gemini outage")
+            return SimpleNamespace(text=self.model.ANSWER)
+        # A failing stream breaks before its first chunk, like a rejected request
+        if failed:
+            await asyncio.sleep(seconds / len(self.model.pieces))
+            raise ServiceUnavailable("simulated Gemini outage")
+        return self._stream(seconds / len(self.model.pieces))
+
+    async def _stream(self, interval):
+        for piece in self.model.pieces:
+            await asyncio.sleep(interval)
+            yield SimpleNamespace(text=piece)
+
+
+class FakeGeminiModel:
+    """Stand-in for the Gemini model behind the real GeminiHandler: a canned answer after a
+    simulated latency, failing with a 503 at the given rate
+    """
+    ANSWER = (
+        "Your hemoglobin is within the normal range. Your fasting blood glucose is slightly above "
+        "the reference interval, which can happen with early insulin resistance. Your creatinine "
+        "and urea are normal, so kidney function looks fine.\nPlease discuss these results with "
+        "your doctor and repeat the glucose test in three months."
+    )
+
+    def __init__(self, latency, error_rate=0.0, pieces=12, seed=4):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        words = self.ANSWER.split(" ")
+        step = max(1, math.ceil(len(words) / pieces))
+        self.pieces = [" ".join(words[i:i + step]) + " " for i in range(0, len(words), step)]
+        self.pieces[-1] = self.pieces[-1].rstrip(" ")
+
+    def start_chat(self, history=None):
+        return FakeGeminiChat(self)
+
+
+class SimulatedVectorStore(app.LocalVectorStore):
+    """In-process index with a network round trip added to every call, standing in for Pinecone"""
+    store_label = "simulated"
+
+    def __init__(self, latency, persist_dir=""):
+        super().__init__(persist_dir=persist_dir)
+        self.latency = latency
+
+    def document_vector_count(self, doc_id):
+        time.sleep(self.latency.sample())
+        return super().document_vector_count(doc_id)
+
+    def upsert_vectors(self, vectors, texts, file_name, doc_id=None, progress=None):
+        time.sleep(self.latency.sample())
+        return super().upsert_vectors(vectors, texts, file_name, doc_id=doc_id, progress=progress)
+
+    def query_vectors(self, query_vector, top_k=3, doc_id=None):
+        time.sleep(self.latency.sample())
+        return super().query_vectors(query_vector, top_k=top_k, doc_id=doc_id)
+
+
+class SampledTranslationBackend(app.StubTranslationBackend):
+    """The offline stub translator with sampled instead of fixed latency"""
+    def __init__(self, latency):
+        super().__init__()
+        self.latency_model = latency
+
+    async def translate_async(self, text, target_lang):
+        await asyncio.sleep(self.latency_model.sample())
+        return await super().translate_async(text, target_lang)
+
+
+def install_fakes(args, persist_dir=""):
+    """Point the app's lazily built services at the offline fakes"""
+    model = FakeGeminiModel(LatencyModel(args.gemini_ms, args.latency, seed=1), error_rate=args.gemini_error_rate)
+    app.services.override(
+        gemini_handler=app.GeminiHandler(app.chat_sessions, model=model),
+        vector_store=SimulatedVectorStore(LatencyModel(args.vector_ms, args.latency, seed=2), persist_dir=persist_dir),
+    )
+    app.translation_client = app.TranslationClient(
+        SampledTranslationBackend(LatencyModel(args.translate_ms, args.latency, seed=3))
+    )
+    app.STREAM_RESPONSES = not args.no_stream
+    app.LAB_FAST_PATH_ENABLED = not args.no_lab_fast_path
+    # The upload handler polls job progress; poll finely so upload latency is not quantized
+    app.INGEST_PROGRESS_INTERVAL_SECONDS = 0.02
+
+
+def text_pdf(pages):
+    """Write a minimal PDF with a Helvetica text layer, one page per text"""
+    objects = [b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    pages_ref = 2 * len(pages) + 2
+    kids = []
+    for text in pages:
+        ops = ["BT /F1 9 Tf 36 806 Td 11 TL"]
+        for line in text.splitlines():
+            line = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            ops.append(f"({line}) Tj T*")
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append((
+            f"<< /Type /Page /Parent {pages_ref} 0 R /MediaBox [0 0 595 842] "
+            f"/Contents {len(objects)} 0 R /Resources << /Font << /F1 1 0 R >> >> >>"
+        ).encode())
+        kids.append(len(objects))
+    objects.append(f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>".encode())
+    objects.append(f"<< /Type /Catalog /Pages {pages_ref} 0 R >>".encode())
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, len(objects), xref)
+    return out
+
+
+def scanned_pdf(pages, dpi=150):
+    """Render each page to an image-only PDF, the way a scanner would deliver it"""
+    from PIL import Image, ImageDraw, ImageFont
+    try:
+        font = ImageFont.load_default(size=dpi // 6)
+    except TypeError:
+        font = ImageFont.load_default()
+    images = []
+    for text in pages:
+        image = Image.new("L", (int(8.27 * dpi), int(11.69 * dpi)), 255)
+        draw = ImageDraw.Draw(image)
+        y = dpi // 2
+        for line in text.splitlines():
+            draw.text((dpi // 2, y), line, fill=0, font=font)
+            y += dpi // 4
+        images.append(image)
+    buffer = BytesIO()
+    images[0].save(buffer, format="PDF", save_all=True, append_images=images[1:], resolution=dpi)
+    return buffer.getvalue()
+
+
+def ocr_available():
+    return bool(shutil.which("tesseract") and shutil.which("pdftoppm"))
+
+
+def synthetic_corpus(directory, count, pages, scanned_every, seed):
+    """Write `count` distinct lab reports; every `scanned_every`-th one is image-only"""
+    uploads = []
+    for i in range(count):
+        report = synthetic_lab_report(pages, seed=seed + i)
+        scanned = bool(scanned_every) and i % scanned_every == scanned_every - 1
+        path = os.path.join(directory, f"report-{seed + i}{'-scanned' if scanned else ''}.pdf")
+        with open(path, "wb") as f:
+            f.write(scanned_pdf(report) if scanned else text_pdf(report))
+        uploads.append(app.gr.utils.NamedString(path))
+    return uploads
+
+
+# Chat questions in all twelve supported languages
+PIPELINE_QUESTIONS = [text for text, _ in LANGID_SAMPLES]
+
+
+def percentiles(values):
+    if not values:
+        return "-", "-", "-"
+    return tuple(f"{value * 1000:.0f}" for value in np.percentile(values, [50, 95, 99]))
+
+
+async def simulate_user(session_id, upload, questions, results):
+    """One user: upload a report, wait for it to be processed, then ask questions in turn"""
+    request = SimpleNamespace(session_hash=session_id)
+    start = time.perf_counter()
+    status = ""
+    async for status, _ in app.process_pdf_ui(upload, request):
+        pass
+    results['upload'].append(time.perf_counter() - start)
+    if app.chat_sessions.document(session_id) is None:
+        results['failed_uploads'].append(status.splitlines()[0])
+        return
+    for question in questions:
+        start = time.perf_counter()
+        first_output = None
+        async for _ in app.predict(question, [], "auto", session_id):
+            if first_output is None:
+                first_output = time.perf_counter() - start
+        results['first_output'].append(first_output)
+        results['chat'].append(time.perf_counter() - start)
+
+
+async def run_pipeline(users, uploads, questions_per_user, run_id):
+    results = {'upload': [], 'first_output': [], 'chat': [], 'failed_uploads': []}
+    tasks = []
+    for user in range(users):
+        offset = user * questions_per_user
+        questions = [PIPELINE_QUESTIONS[(offset + i) % len(PIPELINE_QUESTIONS)] for i in range(questions_per_user)]
+        tasks.append(simulate_user(f"bench-{run_id}-{user}", uploads[user], questions, results))
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    results['wall'] = time.perf_counter() - start
+    return results
+
+
+def bench_pipeline(args):
+    install_fakes(args)
+    scanned_every = args.scanned_every
+    if scanned_every and not ocr_available():
+        print("[Benchmark] tesseract/pdftoppm not found: scanned reports are left out of the corpus")
+        scanned_every = 0
+    processor = app.services.doc_processor
+    processor.ocr_workers = max(1, args.ocr_workers)
+    if args.trace_memory:
+        tracemalloc.start()
+
+    print(f"{'users':>6}{'chats':>7}{'chat/s':>8}{'first p50/95/99 ms':>22}{'total p50/95/99 ms':>22}"
+          f"{'upload p50/95/99 ms':>23}{'failed':>8}{'peak MB':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for run_id, users in enumerate(args.users):
+            uploads = synthetic_corpus(directory, users, args.pages, scanned_every, seed=1000 * (run_id + 1))
+            if args.trace_memory:
+                tracemalloc.reset_peak()
+            results = asyncio.run(run_pipeline(users, uploads, args.questions, run_id))
+            if args.trace_memory:
+                peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+            else:
+                # ru_maxrss is in KiB on Linux; it is the process high-water mark, not per run
+                peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            chats = len(results['chat'])
+            print(f"{users:>6}{chats:>7}{chats / results['wall']:>8.1f}"
+                  f"{'/'.join(percentiles(results['first_output'])):>22}"
+                  f"{'/'.join(percentiles(results['chat'])):>22}"
+                  f"{'/'.join(percentiles(results['upload'])):>23}"
+                  f"{len(results['failed_uploads']):>8}{peak_mb:>9.0f}")
+            for reason in sorted(set(results['failed_uploads'])):
+                print(f"       upload failed: {reason}")
+    print(f"[Benchmark] Embedding: {processor.embedding_service.stats()}")
+    print(f"[Benchmark] Translation cache: {app.translation_client.stats()}")
+    print(f"[Benchmark] Answer cache: {app.answer_cache.stats()}")
+    print(f"[Benchmark] Upstreams: gemini {app.gemini_upstream.stats()}, translation {app.translation_upstream.stats()}")
+    counters = app.metrics.snapshot()['counters']
+    for (name, labels), value in sorted(counters.items()):
+        if name.startswith(('upstream_', 'chat_fallbacks')):
+            print(f"[Benchmark]   {name}{dict(labels)} {value}")
+
+
+async def _serve_scaling_share(worker, workers, uploads, questions, barrier):
+    """One worker process's share of a scaling run.
+
+    Requests are routed round-robin without session affinity: user u uploads on
+    worker u % N and asks question k on worker (u + 1 + k) % N, so every chat
+    depends on state written by another process when N > 1.
+    """
+    results = {'upload': [], 'first_output': [], 'chat': [], 'failed_uploads': [], 'lost_context': 0}
+    users = range(len(uploads))
+
+    async def upload(user):
+        request = SimpleNamespace(session_hash=f"user-{user}")
+        start = time.perf_counter()
+        status = ""
+        async for status, _ in app.process_pdf_ui(app.gr.utils.NamedString(uploads[user]), request):
+            pass
+        results['upload'].append(time.perf_counter() - start)
+        if status.startswith("❌"):
+            results['failed_uploads'].append(status.splitlines()[0])
+
+    async def ask(user, question):
+        start = time.perf_counter()
+        first_output = None
+        response = ""
+        async for response in app.predict(question, [], "auto", f"user-{user}"):
+            if first_output is None:
+                first_output = time.perf_counter() - start
+        if response.startswith("Please upload"):
+            results['lost_context'] += 1
+        results['first_output'].append(first_output)
+        results['chat'].append(time.perf_counter() - start)
+
+    await asyncio.to_thread(barrier.wait)
+    start = time.perf_counter()
+    await asyncio.gather(*(upload(user) for user in users if user % workers == worker))
+    await asyncio.to_thread(barrier.wait)
+    results['upload_wall'] = time.perf_counter() - start
+    start = time.perf_counter()
+    for k in range(questions):
+        asked = [user for user in users if (user + 1 + k) % workers == worker]
+        await asyncio.gather(*(ask(user, PIPELINE_QUESTIONS[(user + k) % len(PIPELINE_QUESTIONS)]) for user in asked))
+        # Each user's next question waits until every worker has answered this round
+        await asyncio.to_thread(barrier.wait)
+    results['chat_wall'] = time.perf_counter() - start
+    return results
+
+
+def _scaling_worker(worker, workers, uploads, args, barrier, output):
+    """Entry point of a spawned app worker process; the shared state location comes from the environment"""
+    try:
+        install_fakes(args, persist_dir=app.LOCAL_VECTOR_DIR)
+        app.services.doc_processor.ocr_workers = max(1, args.ocr_workers)
+        # Load the embedding model before the timed phases start
+        app.services.doc_processor.embedding_service.submit(["warm up"]).result()
+        output.put(asyncio.run(_serve_scaling_share(worker, workers, uploads, args.questions, barrier)))
+    except Exception as e:
+        # Release the other workers waiting at the barrier
+        barrier.abort()
+        output.put({'error': f"worker {worker}: {type(e).__name__}: {str(e)}"})
+
+
+def bench_workers(args):
+    scanned_every = args.scanned_every
+    if scanned_every and not ocr_available():
+        print("[Benchmark] tesseract/pdftoppm not found: scanned reports are left out of the corpus")
+        scanned_every = 0
+    context = multiprocessing.get_context("spawn")
+    print(f"[Benchmark] State backend: {args.state}, {args.users} users, {args.questions} questions each")
+    print(f"{'workers':>8}{'chats':>7}{'chat/s':>8}{'speedup':>9}{'first p50/95/99 ms':>22}{'total p50/95/99 ms':>22}"
+          f"{'uploads/s':>11}{'lost':>6}{'failed':>8}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as corpus:
+        uploads = [str(path) for path in synthetic_corpus(corpus, args.users, args.pages, scanned_every, seed=5000)]
+        for workers in args.workers:
+            with tempfile.TemporaryDirectory() as state_dir:
+                # Spawned workers read these when they import the app
+                os.environ.update({
+                    'STATE_BACKEND': args.state,
+                    'STATE_DIR': os.path.join(state_dir, "state"),
+                    'LOCAL_VECTOR_DIR': os.path.join(state_dir, "vectors"),
+                    'EXTRACTION_CACHE_DIR': "",
+                })
+                barrier = context.Barrier(workers)
+                output = context.Queue()
+                processes = [
+                    context.Process(target=_scaling_worker, args=(worker, workers, uploads, args, barrier, output))
+                    for worker in range(workers)
+                ]
+                for process in processes:
+                    process.start()
+                shares = [output.get() for _ in processes]
+                for process in processes:
+                    process.join()
+            errors = sorted({share['error'] for share in shares if 'error' in share})
+            if errors:
+                print(f"{workers:>8}  run failed: {errors[0]}")
+                continue
+            results = {key: [value for share in shares for value in share[key]]
+                       for key in ('upload', 'first_output', 'chat', 'failed_uploads')}
+            chats = len(results['chat'])
+            throughput = chats / max(share['chat_wall'] for share in shares)
+            baseline = baseline or throughput
+            print(f"{workers:>8}{chats:>7}{throughput:>8.1f}{throughput / baseline:>8.2f}x"
+                  f"{'/'.join(percentiles(results['first_output'])):>22}"
+                  f"{'/'.join(percentiles(results['chat'])):>22}"
+                  f"{len(results['upload']) / max(share['upload_wall'] for share in shares):>11.1f}"
+                  f"{sum(share['lost_context'] for share in shares):>6}{len(results['failed_uploads']):>8}")
+            for reason in sorted(set(results['failed_uploads'])):
+                print(f"         upload failed: {reason}")
+
+
+def _embedding_worker(backend, threads, texts, repeat):
+    """Load one backend in a fresh process and time it, so RSS reflects a single worker"""
+    start = time.perf_counter()
+    model = app.load_embedding_model(backend, threads)
+    load_seconds = time.perf_counter() - start
+    model.encode(texts[:8])
+    start = time.perf_counter()
+    for _ in range(repeat):
+        vectors = model.encode(texts, batch_size=app.EMBED_BATCH_SIZE)
+    encode_seconds = time.perf_counter() - start
+    stats = {
+        'load_seconds': load_seconds,
+        'texts_per_second': repeat * len(texts) / encode_seconds,
+        # ru_maxrss is in KiB on Linux
+        'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    return stats, np.asarray(vectors, dtype=np.float32)
+
+
+def bench_embedding(args):
+    pages = synthetic_lab_report(args.pages)
+    lines = [line for page in pages for line in page.splitlines()]
+    # Single lines resemble queries, groups of lines resemble ingestion chunks
+    texts = lines + ["\n".join(lines[i:i + 6]) for i in range(0, len(lines), 6)] + [text for text, _ in LANGID_SAMPLES]
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for backend in args.backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            try:
+                results[backend] = pool.submit(_embedding_worker, backend, args.threads, texts, args.repeat).result()
+            except Exception as e:
+                print(f"[Benchmark] {backend} backend failed: {str(e)}")
+
+    reference = results.get('torch')
+    print(f"{'backend':<12}{'load s':>8}{'texts/s':>10}{'RSS MB':>9}{'min cos':>9}{'mean cos':>10}")
+    for backend, (stats, vectors) in results.items():
+        min_cos = mean_cos = "-"
+        if reference is not None:
+            expected = reference[1]
+            cosines = (vectors * expected).sum(axis=1) / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(expected, axis=1))
+            min_cos, mean_cos = f"{cosines.min():.4f}", f"{cosines.mean():.4f}"
+        print(f"{backend:<12}{stats['load_seconds']:>8.1f}{stats['texts_per_second']:>10.0f}{stats['rss_mb']:>9.0f}{min_cos:>9}{mean_cos:>10}")
+    print(f"[Benchmark] {len(texts)} texts x {args.repeat} passes; parity is cosine similarity against torch "
+          f"(the app requires >= {app.EMBEDDING_PARITY_MIN_COSINE} when EMBEDDING_PARITY_CHECK is on)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    chunker = subparsers.add_parser("chunker", help="Compare the streaming chunker with the legacy character chunker")
+    chunker.add_argument("pdfs", nargs="*", help="PDF reports to chunk (defaults to a synthetic lab report)")
+    chunker.add_argument("--pages", type=int, default=6, help="Pages in the synthetic report")
+    chunker.add_argument("--ocr-workers", type=int, default=1)
+    chunker.set_defaults(func=bench_chunker)
+
+    langid = subparsers.add_parser("langid", help="Compare script-based language ID with langdetect")
+    langid.add_argument("--repeat", type=int, default=20, help="Passes over the sample queries")
+    langid.set_defaults(func=bench_langid)
+
+    pipeline = subparsers.add_parser("pipeline", help="Drive uploads and chats end to end against offline fakes")
+    pipeline.add_argument("--users", type=int, nargs="+", default=[1, 4, 16], help="Concurrent users, one run per value")
+    pipeline.add_argument("--questions", type=int, default=5, help="Questions asked by each user")
+    pipeline.add_argument("--pages", type=int, default=6, help="Pages per synthetic report")
+    pipeline.add_argument("--scanned-every", type=int, default=4, help="Make every Nth report image-only (0 for none)")
+    pipeline.add_argument("--gemini-ms", type=float, default=800, help="Mean simulated Gemini response time")
+    pipeline.add_argument("--gemini-error-rate", type=float, default=0.0, help="Fraction of Gemini calls failing with a 503")
+    pipeline.add_argument("--vector-ms", type=float, default=40, help="Mean simulated vector store round trip")
+    pipeline.add_argument("--translate-ms", type=float, default=120, help="Mean simulated translation round trip")
+    pipeline.add_argument("--latency", choices=["fixed", "lognormal"], default="lognormal")
+    pipeline.add_argument("--no-stream", action="store_true", help="Benchmark the non-streaming response path")
+    pipeline.add_argument("--no-lab-fast-path", action="store_true", help="Send lab value lookups to Gemini too")
+    pipeline.add_argument("--ocr-workers", type=int, default=app.OCR_WORKERS)
+    pipeline.add_argument("--trace-memory", action="store_true", help="Report the tracemalloc peak per run instead of process RSS")
+    pipeline.set_defaults(func=bench_pipeline)
+
+    workers = subparsers.add_parser("workers", help="Measure chat throughput as app worker processes are added")
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker processes, one run per value")
+    workers.add_argument("--state", choices=["memory", "sqlite", "redis"], default="sqlite",
+                         help="State backend shared by the workers (memory shows what is lost without one)")
+    workers.add_argument("--users", type=int, default=16, help="Users, each with their own report")
+    workers.add_argument("--questions", type=int, default=5, help="Questions asked by each user")
+    workers.add_argument("--pages", type=int, default=6, help="Pages per synthetic report")
+    workers.add_argument("--scanned-every", type=int, default=4, help="Make every Nth report image-only (0 for none)")
+    workers.add_argument("--gemini-ms", type=float, default=800, help="Mean simulated Gemini response time")
+    workers.add_argument("--gemini-error-rate", type=float, default=0.0, help="Fraction of Gemini calls failing with a 503")
+    workers.add_argument("--vector-ms", type=float, default=40, help="Mean simulated vector store round trip")
+    workers.add_argument("--translate-ms", type=float, default=120, help="Mean simulated translation round trip")
+    workers.add_argument("--latency", choices=["fixed", "lognormal"], default="lognormal")
+    workers.add_argument("--no-stream", action="store_true", help="Benchmark the non-streaming response path")
+    workers.add_argument("--no-lab-fast-path", action="store_true", help="Send lab value lookups to Gemini too")
+    workers.add_argument("--ocr-workers", type=int, default=1, help="OCR processes per app worker")
+    workers.set_defaults(func=bench_workers)
+
+    embedding = subparsers.add_parser("embedding", help="Compare embedding backends: throughput, RSS and parity")
+    embedding.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx-int8"], choices=["torch", "onnx", "onnx-int8"])
+    embedding.add_argument("--threads", type=int, default=app.EMBEDDING_THREADS, help="Runtime threads per worker (0 = default)")
+    embedding.add_argument("--pages", type=int, default=6, help="Pages of synthetic report text to embed")
+    embedding.add_argument("--repeat", type=int, default=5, help="Timed passes over the texts")
+    embedding.set_defaults(func=bench_embedding)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
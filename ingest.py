@@ -0,0 +1,240 @@
+"""
+Bulk ingestion of archived medical reports, without the Gradio UI.
+
+Usage:
+    python ingest.py reports/                      # every PDF under a directory
+    python ingest.py --manifest reports.txt        # one PDF path per line
+    python ingest.py reports/ --workers 8 --embed-batch 512 --checkpoint backfill.jsonl
+
+Extraction, OCR and chunking run in a process pool (one report per worker); the
+parent embeds chunks from several reports per encode call and upserts them into
+the configured vector store. Every finished report is appended to the checkpoint
+file, so an interrupted run resumes where it stopped.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import app
+
+_worker_processor = None
+
+
+def _init_worker(ocr_dpi):
+    """Each pool worker extracts and chunks with its own tokenizer-only DocumentProcessor"""
+    global _worker_processor
+    _worker_processor = app.DocumentProcessor(ocr_dpi=ocr_dpi, ocr_workers=1, embed=False)
+
+
+def _extract_and_chunk(path):
+    """Runs in a pool worker: return (path, doc_id, pages, chunks, error)"""
+    try:
+        with open(path, 'rb') as f:
+            file_bytes = f.read()
+        doc_id = app.content_hash(file_bytes)
+        pages = list(_worker_processor.iter_page_texts(file_bytes))
+        chunks = list(_worker_processor.iter_chunks(pages))
+        return path, doc_id, pages, chunks, None
+    except Exception as e:
+        return path, None, [], [], str(e)
+
+
+def _result(future, path):
+    """The (path, doc_id, pages, chunks, error) of a finished report, failed if its worker died"""
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        return path, None, [], [], "worker process died"
+    except Exception as e:
+        return path, None, [], [], str(e)
+
+
+def start_pool(workers, ocr_dpi):
+    """Workers are spawned, not forked, so they do not inherit the parent's model and threads"""
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(ocr_dpi,))
+
+
+def find_reports(directory=None, manifest=None):
+    """PDF paths from a directory walk or a manifest file (blank lines and # comments ignored)"""
+    paths = []
+    if manifest:
+        with open(manifest, encoding="utf-8") as f:
+            paths.extend(line.strip() for line in f if line.strip() and not line.lstrip().startswith("#"))
+    if directory:
+        for root, _, files in os.walk(directory):
+            paths.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith(".pdf"))
+    return paths
+
+
+def load_checkpoint(path):
+    """Paths already ingested or skipped by earlier runs, and paths that failed"""
+    finished, failed = set(), set()
+    if not os.path.exists(path):
+        return finished, failed
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by the interruption
+                continue
+            if record.get('status') == 'failed':
+                failed.add(record['path'])
+            else:
+                finished.add(record['path'])
+                failed.discard(record['path'])
+    return finished, failed
+
+
+def create_store():
+    """Vector store for backfilled reports: their namespaces never expire and no cleanup thread runs"""
+    if app.VECTOR_STORE == "local":
+        if not app.LOCAL_VECTOR_DIR:
+            print("[Ingest] LOCAL_VECTOR_DIR is not set: vectors will be lost when this process exits")
+        return app.LocalVectorStore(namespace_ttl=None)
+    store = app.PineconeHandler(namespace_ttl=None)
+    if store.index is None:
+        sys.exit("[Ingest] Pinecone is unavailable; refusing to fall back to a temporary local index")
+    return store
+
+
+class BulkIngester:
+    """Embeds and stores extracted reports in groups, recording each one in the checkpoint"""
+    def __init__(self, processor, store, checkpoint, embed_batch):
+        self.processor = processor
+        self.store = store
+        self.checkpoint = checkpoint
+        self.embed_batch = embed_batch
+        self.indexed = set(store.list_namespaces())
+        self.pending = []
+        self.counts = {'done': 0, 'skipped': 0, 'failed': 0, 'pages': 0, 'chunks': 0}
+
+    def record(self, path, status, **fields):
+        self.counts[status] += 1
+        self.checkpoint.write(json.dumps({'path': path, 'status': status, **fields}, ensure_ascii=False) + "\n")
+        self.checkpoint.flush()
+
+    def add(self, path, doc_id, pages, chunks, error):
+        if error is not None:
+            print(f"[Ingest] {path}: {error}")
+            self.record(path, 'failed', error=error)
+            return
+        self.counts['pages'] += len(pages)
+        if app.document_namespace(doc_id) in self.indexed:
+            self.record(path, 'skipped', doc_id=doc_id, reason="already indexed")
+            return
+        if not chunks:
+            self.record(path, 'failed', doc_id=doc_id, error="no text extracted")
+            return
+        self.pending.append((path, doc_id, pages, chunks))
+        if sum(len(item[3]) for item in self.pending) >= self.embed_batch:
+            self.flush()
+
+    def flush(self):
+        """Embed all pending reports in one encode call, then upsert each into its namespace"""
+        if not self.pending:
+            return
+        texts = [chunk for _, _, _, chunks in self.pending for chunk in chunks]
+        embeddings = self.processor.embedding_service.submit(texts).result()
+        offset = 0
+        for path, doc_id, pages, chunks in self.pending:
+            vectors = embeddings[offset:offset + len(chunks)]
+            offset += len(chunks)
+            if app.document_namespace(doc_id) in self.indexed:
+                # Duplicate file earlier in the same group
+                self.record(path, 'skipped', doc_id=doc_id, reason="duplicate")
+                continue
+            upsert = self.store.upsert_vectors(vectors, chunks, os.path.basename(path), doc_id=doc_id)
+            if not upsert['upserted']:
+                self.record(path, 'failed', doc_id=doc_id, error="vector upsert failed")
+                continue
+            app.store_document_indexes(self.processor.cache, doc_id, pages, chunks)
+            self.indexed.add(app.document_namespace(doc_id))
+            self.counts['chunks'] += upsert['upserted']
+            self.record(path, 'done', doc_id=doc_id, pages=len(pages), chunks=len(chunks), failed_chunks=upsert['failed'])
+        self.pending = []
+
+
+def report(counts, elapsed, final=False):
+    documents = counts['done'] + counts['skipped'] + counts['failed']
+    print(
+        f"[Ingest]{' Finished:' if final else ''} {documents} reports ({counts['done']} ingested, "
+        f"{counts['skipped']} skipped, {counts['failed']} failed) in {elapsed:.0f}s - "
+        f"{documents / elapsed:.2f} docs/s, {counts['pages'] / elapsed:.1f} pages/s, {counts['chunks']} chunks stored"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", nargs="?", help="Directory searched recursively for PDF reports")
+    parser.add_argument("--manifest", help="File listing PDF paths, one per line")
+    parser.add_argument("--checkpoint", default="ingest_checkpoint.jsonl", help="Progress file used to resume")
+    parser.add_argument("--retry-failed", action="store_true", help="Process reports that failed in earlier runs again")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Extraction/OCR processes")
+    parser.add_argument("--embed-batch", type=int, default=512, help="Chunks embedded per encode call")
+    parser.add_argument("--ocr-dpi", type=int, default=app.OCR_DPI)
+    parser.add_argument("--report-every", type=int, default=25, help="Print throughput every N reports")
+    args = parser.parse_args()
+    if not args.directory and not args.manifest:
+        parser.error("give a directory, a --manifest, or both")
+
+    paths = find_reports(args.directory, args.manifest)
+    finished, failed = load_checkpoint(args.checkpoint)
+    todo = [path for path in dict.fromkeys(paths) if path not in finished and (args.retry_failed or path not in failed)]
+    print(f"[Ingest] {len(paths)} reports found, {len(paths) - len(todo)} already handled, {len(todo)} to process")
+    if not todo:
+        return
+
+    processor = app.DocumentProcessor(ocr_workers=1)
+    processor.embedding_service.batch_size = args.embed_batch
+    store = create_store()
+    start = time.perf_counter()
+    pool = start_pool(args.workers, args.ocr_dpi)
+    with open(args.checkpoint, "a", encoding="utf-8") as checkpoint:
+        ingester = BulkIngester(processor, store, checkpoint, args.embed_batch)
+        remaining = iter(todo)
+        in_flight = {}
+        handled = 0
+        try:
+            while True:
+                # Keep a bounded number of reports in flight so extracted text does not pile up
+                while len(in_flight) < 2 * args.workers:
+                    path = next(remaining, None)
+                    if path is None:
+                        break
+                    in_flight[pool.submit(_extract_and_chunk, path)] = path
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # A worker was killed (e.g. out of memory); every report still in the pool fails with it
+                    done, _ = wait(in_flight)
+                    lost = sum(isinstance(future.exception(), BrokenProcessPool) for future in done)
+                    print(f"[Ingest] A worker process died; {lost} reports in flight marked failed "
+                          f"(rerun with --retry-failed), restarting the pool")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = start_pool(args.workers, args.ocr_dpi)
+                for future in done:
+                    ingester.add(*_result(future, in_flight.pop(future)))
+                    handled += 1
+                    if handled % args.report_every == 0:
+                        report(ingester.counts, time.perf_counter() - start)
+            ingester.flush()
+        except KeyboardInterrupt:
+            print("[Ingest] Interrupted; storing reports already embedded in this group")
+            for future in in_flight:
+                future.cancel()
+            ingester.flush()
+        finally:
+            pool.shutdown(cancel_futures=True)
+        report(ingester.counts, time.perf_counter() - start, final=True)
+
+
+if __name__ == "__main__":
+    main()
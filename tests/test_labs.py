@@ -0,0 +1,92 @@
+from io import BytesIO
+
+import PyPDF2
+
+import app
+
+
+REPORT_ROWS = [
+    ("Test Name", "Result", "Unit", "Biological Reference Interval"),
+    ("Hemoglobin", "11.2", "g/dL", "13.0 - 17.0"),
+    ("Total Leukocyte Count", "7.5", "10^3/uL", "4.0 - 11.0"),
+    ("Fasting Blood Glucose", "112", "mg/dL", "70 - 100"),
+    ("Serum Creatinine", "0.9", "mg/dL", "0.7 - 1.3"),
+    ("Vitamin D (25-OH)", "18.4", "ng/mL", "30 - 100"),
+]
+NOTE = "Please repeat the test in 3 months."
+HEADER_LINES = ["Sample ID 12345 Collected 10:30 AM", "Time 09:15 hrs"]
+
+
+def table_pdf(rows, note):
+    """One-page PDF with every table cell placed on its own, as report generators lay them out"""
+    ops = ["BT /F1 9 Tf"]
+    y = 800
+    for row in rows:
+        for x, cell in zip((36, 220, 290, 370), row):
+            ops.append(f"1 0 0 1 {x} {y} Tm ({cell}) Tj")
+        y -= 14
+    ops.append(f"1 0 0 1 36 {y - 14} Tm ({note}) Tj")
+    ops.append("ET")
+    stream = "\n".join(ops).encode("latin-1")
+    objects = [
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream",
+        b"<< /Type /Page /Parent 4 0 R /MediaBox [0 0 595 842] /Contents 2 0 R /Resources << /Font << /F1 1 0 R >> >> >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Catalog /Pages 4 0 R >>",
+    ]
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 5 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return out
+
+
+def extracted_labs():
+    reader = PyPDF2.PdfReader(BytesIO(table_pdf(REPORT_ROWS, NOTE)))
+    return app.LabTable.from_pages([page.extract_text() for page in reader.pages])
+
+
+def test_rows_from_single_space_extraction():
+    labs = extracted_labs()
+    assert [result.name for result in labs.results] == [row[0] for row in REPORT_ROWS[1:]]
+    hemoglobin = labs.results[0]
+    assert (hemoglobin.value, hemoglobin.unit, hemoglobin.low, hemoglobin.high, hemoglobin.status) == (
+        11.2, "g/dL", 13.0, 17.0, "low"
+    )
+
+
+def test_prose_is_not_a_row():
+    assert app.parse_lab_line(NOTE) is None
+    assert app.parse_lab_line("Patient age 52 years") is None
+    for line in HEADER_LINES:
+        assert app.parse_lab_line(line) is None
+
+
+def test_header_lines_give_no_fast_path_answer():
+    reader = PyPDF2.PdfReader(BytesIO(table_pdf(REPORT_ROWS, NOTE)))
+    labs = app.LabTable.from_pages(["\n".join(HEADER_LINES)] + [page.extract_text() for page in reader.pages])
+    assert len(labs) == len(REPORT_ROWS) - 1
+    for query in ("when was my sample collected", "what is my sample id"):
+        rows = labs.find(query)
+        assert rows == []
+        assert not app.is_lab_value_lookup(query, rows)
+
+
+def test_generic_words_identify_no_test():
+    labs = extracted_labs()
+    assert labs.find("what is my blood count") == []
+    assert labs.find("total?") == []
+
+
+def test_fast_path_needs_one_identified_test():
+    labs = extracted_labs()
+    rows = labs.find("what is my blood sugar")
+    assert [result.name for result in rows] == ["Fasting Blood Glucose"]
+    assert app.is_lab_value_lookup("what is my blood sugar", rows)
+    assert not app.is_lab_value_lookup("hemoglobin and creatinine", labs.find("hemoglobin and creatinine"))
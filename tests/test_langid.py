@@ -0,0 +1,26 @@
+import pytest
+
+import app
+from benchmark import LANGID_SAMPLES
+
+
+@pytest.mark.parametrize("text, expected", LANGID_SAMPLES)
+def test_samples(text, expected):
+    assert app.identify_language(text) == expected
+
+
+def test_shared_marker_decides_nothing():
+    assert not app.MARATHI_MARKERS & app.HINDI_MARKERS
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("আমার রিপোর্ট ঠিক আছে। ধন্যবাদ।", "bn"),
+    ("ਮੇਰੀ ਰਿਪੋਰਟ ਠੀਕ ਹੈ। ਧੰਨਵਾਦ।", "pa"),
+    ("ঠিক।।।", "bn"),
+])
+def test_danda_does_not_count_as_devanagari(text, expected):
+    assert app.identify_language(text) == expected
+
+
+def test_emoji_is_not_urdu():
+    assert app.identify_language("❤️❤️") == "en"
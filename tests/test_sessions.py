@@ -0,0 +1,37 @@
+import threading
+
+import app
+
+
+def shared_stores(tmp_path, count):
+    """Session stores over separate connections to one SQLite file, as separate worker processes have"""
+    path = str(tmp_path / "sessions.sqlite3")
+    return [app.SharedChatSessionStore(app.SqliteState(path), history_max_tokens=10**6) for _ in range(count)]
+
+
+def test_concurrent_turns_are_all_kept(tmp_path):
+    stores = shared_stores(tmp_path, 4)
+    stores[0].set_document("s1", {'doc_id': "d1"})
+
+    def chat(store, worker):
+        for turn in range(25):
+            store.record_turn("s1", f"question {worker}-{turn}", "answer")
+
+    threads = [threading.Thread(target=chat, args=(store, worker)) for worker, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(stores[0].history("s1")) == 2 * 4 * 25
+
+
+def test_reads_do_not_write(tmp_path):
+    store, = shared_stores(tmp_path, 1)
+    assert store.document("unknown") is None
+    assert store.history("unknown") == []
+    assert store.stats()['keys'] == 0
+
+    store.set_document("s1", {'doc_id': "d1"})
+    expires_at = store.state._db.execute("SELECT expires_at FROM entries").fetchone()[0]
+    assert store.document("s1") == {'doc_id': "d1"}
+    assert store.state._db.execute("SELECT expires_at FROM entries").fetchone()[0] == expires_at
@@ -0,0 +1,40 @@
+import asyncio
+from urllib.parse import parse_qs
+
+import httpx
+
+import app
+
+
+def test_google_backend_sends_text_in_the_body():
+    backend = app.GoogleTranslateBackend()
+    # A worst-case segment: every character percent-encodes to nine bytes
+    segment = "ह" * app.TRANSLATION_SEGMENT_CHARS
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json=[[["अनुवाद", segment, None, None]]])
+
+    async def translate():
+        loop = asyncio.get_running_loop()
+        backend._async_clients[loop] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        return await backend.translate_async(segment, 'hi')
+
+    assert asyncio.run(translate()) == "अनुवाद"
+    request, = requests
+    assert request.method == "POST"
+    assert len(str(request.url)) < 200
+    assert parse_qs(request.content.decode())['q'] == [segment]
+
+
+def test_google_backend_keeps_one_client_per_loop():
+    backend = app.GoogleTranslateBackend()
+
+    async def client():
+        return backend._get_async_client(), backend._get_async_client()
+
+    first, again = asyncio.run(client())
+    assert first is again
+    second, _ = asyncio.run(client())
+    assert second is not first
@@ -0,0 +1,20 @@
+import numpy as np
+
+import app
+
+
+def test_workers_sharing_a_directory_see_each_other(tmp_path):
+    writer = app.LocalVectorStore(persist_dir=str(tmp_path), namespace_ttl=None)
+    reader = app.LocalVectorStore(persist_dir=str(tmp_path), namespace_ttl=None)
+    assert reader.document_vector_count("d1") == 0
+
+    writer.upsert_vectors(np.eye(2, 4), ["first", "second"], "r.pdf", doc_id="d1")
+    assert reader.document_vector_count("d1") == 2
+
+    writer.upsert_vectors(np.eye(4)[2:], ["third", "fourth"], "r.pdf", doc_id="d1")
+    assert reader.document_vector_count("d1") == 4
+    assert reader.query_vectors(np.eye(4)[3], top_k=1, doc_id="d1").matches[0].metadata["text"] == "fourth"
+
+    writer.delete_namespace(app.document_namespace("d1"))
+    assert reader.document_vector_count("d1") == 0
+    assert reader.list_namespaces() == []